@@ -0,0 +1,359 @@
+import argparse
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import cv2
+import numpy as np
+
+from CVFunctions import crop_scale_bar, bcp_labels, btp_state, btp_corrections, btp_labels, render_overlay
+from ImageSource import open_image
+from batch import init_worker
+
+#local http service around bcp/btp for other lab systems; runs offline on the standard library
+#jobs are images uploaded in the request body or paths under the service root. they are queued onto a
+#process pool and at most `capacity` jobs are accepted at a time; further submissions are refused with
+#503 and a Retry-After header until the queue drains, so clients back off instead of piling up memory
+#
+#  POST /jobs?mode=bcp&name=sample_20x.tif&outputs=labels,overlay[&wait=1]   body: image bytes
+#  POST /jobs                        body: json {"path": ..., "mode": ..., "settings": {...}, "clicks": [...]}
+#  GET  /jobs/<id>                   status, percentages and timings
+#  GET  /jobs/<id>/labels.png        phase label map of the cropped image (values as in phase_names)
+#  GET  /jobs/<id>/overlay.png       rendered overlay
+#  GET  /metrics                     queue depth, counters and latency percentiles
+#
+#the image name matters: the magnification in the name bounds the hough radius band (see radius_band)
+
+phases = {'bcp': ('boron', 'carbon', 'polymer'), 'btp': ('boron', 'tungsten', 'polymer')}
+setting_types = {'boron_sensitivity': int, 'boron_detection_threshold': int, 'radius_inflation': float,
+                 'pyramid_levels': int}
+
+#raised when the queue is at capacity
+class QueueFull(Exception):
+    pass
+
+#png bytes of an image array
+def encode_png(image):
+    ok, buffer = cv2.imencode('.png', image)
+    if not ok:
+        raise ValueError('could not encode png')
+    return buffer.tobytes()
+
+#runs one job in a pool worker; source is the uploaded file's bytes or a path
+#returns the percentages, the requested png outputs and the worker-side start and end times
+def analyse(source, image_file, mode, settings, outputs=(), clicks=None):
+    started = time.time()
+    if isinstance(source, bytes):
+        image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+    else:
+        image = open_image(source)
+    if image is None:
+        raise ValueError(f'could not read image: {image_file}')
+
+    if mode == 'bcp':
+        cropped_image = crop_scale_bar(image)
+        labels, percentages = bcp_labels(image_file, cropped_image, cropped=True, **settings)
+    else:
+        state = btp_state(image_file, image, **settings)
+        if clicks:
+            btp_corrections(state, np.array(clicks, dtype=np.int64).reshape(-1, 2))
+        cropped_image = state['cropped_image']
+        labels, percentages = btp_labels(state)
+
+    result = {'percentages': dict(zip(phases[mode], (float(value) for value in percentages)))}
+    if 'labels' in outputs:
+        result['labels'] = encode_png(labels)
+    if 'overlay' in outputs:
+        result['overlay'] = encode_png(render_overlay(cropped_image, labels))
+    result['started'], result['finished'] = started, time.time()
+    return result
+
+#p50/p95/max of a list of seconds
+def latency_summary(values):
+    if not values:
+        return {'count': 0}
+    values = np.asarray(values)
+    return {'count': len(values), 'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)),
+            'max': float(values.max())}
+
+#bounded job queue on a process pool; finished jobs are kept (lru) so their results can be fetched
+class JobQueue:
+    def __init__(self, workers=None, capacity=16, keep=256, cache_dir=None, low_memory=False):
+        self.workers = workers or os.cpu_count()
+        self.capacity = capacity
+        self.keep = keep
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                            initargs=(cache_dir, low_memory))
+        self.jobs = OrderedDict()
+        self.pending = 0
+        self.counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+        self.latencies = {'wait': deque(maxlen=1000), 'processing': deque(maxlen=1000), 'total': deque(maxlen=1000)}
+        self.lock = threading.Lock()
+
+    def submit(self, source, image_file, mode, settings, outputs=(), clicks=None):
+        with self.lock:
+            if self.pending >= self.capacity:
+                self.counters['rejected'] += 1
+                raise QueueFull()
+            self.pending += 1
+            self.counters['submitted'] += 1
+            job_id = uuid.uuid4().hex
+            job = {'id': job_id, 'image': image_file, 'mode': mode, 'status': 'queued', 'submitted': time.time(),
+                   'done': threading.Event()}
+            self.jobs[job_id] = job
+
+        future = self.executor.submit(analyse, source, image_file, mode, settings, tuple(outputs), clicks)
+        future.add_done_callback(lambda future: self.finish(job, future))
+        return job
+
+    def finish(self, job, future):
+        now = time.time()
+        with self.lock:
+            self.pending -= 1
+            try:
+                result = future.result()
+            except Exception as error:
+                job.update(status='failed', error=str(error), finished=now)
+                self.counters['failed'] += 1
+            else:
+                job.update(status='done', result=result, finished=now)
+                self.counters['completed'] += 1
+                self.latencies['wait'].append(result['started'] - job['submitted'])
+                self.latencies['processing'].append(result['finished'] - result['started'])
+                self.latencies['total'].append(now - job['submitted'])
+
+            #finished jobs beyond `keep` are dropped oldest first; queued ones are never dropped
+            finished = [job_id for job_id, other in self.jobs.items() if other['status'] in ('done', 'failed')]
+            for job_id in finished[:max(0, len(finished) - self.keep)]:
+                del self.jobs[job_id]
+        job['done'].set()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def metrics(self):
+        with self.lock:
+            return {'pending': self.pending, 'running': min(self.pending, self.workers),
+                    'queued': max(0, self.pending - self.workers), 'capacity': self.capacity, 'workers': self.workers,
+                    **self.counters,
+                    'latency_s': {name: latency_summary(list(values)) for name, values in self.latencies.items()}}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+#json view of a job (without the png payloads)
+def job_status(job):
+    status = {key: job[key] for key in ('id', 'image', 'mode', 'status')}
+    if job['status'] == 'done':
+        result = job['result']
+        status['percentages'] = result['percentages']
+        status['wait_s'] = result['started'] - job['submitted']
+        status['processing_s'] = result['finished'] - result['started']
+        status['outputs'] = [f"/jobs/{job['id']}/{output}.png" for output in ('labels', 'overlay') if output in result]
+    elif job['status'] == 'failed':
+        status['error'] = job['error']
+    return status
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    #set on the server: queue, root, max_upload
+    def send_json(self, code, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = urllib.parse.urlparse(self.path).path.strip('/').split('/')
+        if parts == ['metrics']:
+            return self.send_json(200, self.server.queue.metrics())
+        if parts == ['health']:
+            return self.send_json(200, {'status': 'ok'})
+
+        job = self.server.queue.get(parts[1]) if len(parts) >= 2 and parts[0] == 'jobs' else None
+        if job is None:
+            return self.send_json(404, {'error': 'not found'})
+        if len(parts) == 2:
+            return self.send_json(200, job_status(job))
+
+        output = parts[2].removesuffix('.png')
+        if len(parts) != 3 or job['status'] != 'done' or output not in job['result']:
+            return self.send_json(404, {'error': f'no {parts[2]} for this job'})
+        data = job['result'][output]
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if urllib.parse.urlparse(self.path).path.rstrip('/') != '/jobs':
+            return self.send_json(404, {'error': 'not found'})
+        length = int(self.headers.get('Content-Length', 0))
+        if length > self.server.max_upload:
+            return self.send_json(413, {'error': f'upload larger than {self.server.max_upload} bytes'})
+        body = self.rfile.read(length)
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).items()}
+
+        try:
+            request = self.parse_job(query, body)
+            job = self.server.queue.submit(*request)
+        except QueueFull:
+            return self.send_json(503, {'error': 'queue full', **self.server.queue.metrics()},
+                                  headers=[('Retry-After', '1')])
+        except (ValueError, KeyError, TypeError) as error:
+            return self.send_json(400, {'error': str(error)})
+
+        if query.get('wait') in ('1', 'true'):
+            job['done'].wait()
+            return self.send_json(200 if job['status'] == 'done' else 500, job_status(job))
+        self.send_json(202, job_status(job), headers=[('Location', f"/jobs/{job['id']}")])
+
+    #(source, image name, mode, settings, outputs, clicks) from the query string and body
+    def parse_job(self, query, body):
+        options = dict(query)
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            options.update(json.loads(body))
+            if 'path' not in options:
+                raise ValueError('json requests need a path')
+            source = self.resolve_path(options['path'])
+            name = options.get('name', os.path.basename(source))
+        else:
+            if not body:
+                raise ValueError('empty upload')
+            source, name = body, options.get('name', 'upload')
+
+        mode = options.get('mode', 'bcp')
+        if mode not in phases:
+            raise ValueError(f'unknown mode: {mode}')
+        settings = dict(options.get('settings', {}))
+        settings.update({key: options[key] for key in setting_types if key in options})
+        settings = {key: setting_types[key](value) for key, value in settings.items()}
+        outputs = options.get('outputs', [])
+        if isinstance(outputs, str):
+            outputs = [output for output in outputs.split(',') if output]
+        if set(outputs) - {'labels', 'overlay'}:
+            raise ValueError('outputs are labels and/or overlay')
+        return source, name, mode, settings, outputs, options.get('clicks')
+
+    #paths are only served from inside the service root
+    def resolve_path(self, path):
+        root = self.server.root
+        resolved = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, resolved]) != root:
+            raise ValueError('path is outside the service root')
+        if not os.path.isfile(resolved):
+            raise ValueError(f'no such image: {path}')
+        return resolved
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def make_server(host='127.0.0.1', port=8765, workers=None, capacity=16, root='.', max_upload_mb=512,
+                cache_dir=None, low_memory=False, verbose=False):
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.queue = JobQueue(workers, capacity, cache_dir=cache_dir, low_memory=low_memory)
+    server.root = os.path.realpath(root)
+    server.max_upload = max_upload_mb * 1024 * 1024
+    server.verbose = verbose
+    return server
+
+#minimal client: submits one image (uploaded, or by path with by_path) and waits for the result
+#returns the job status; labels/overlay png bytes are fetched when requested
+def submit_image(url, image_path, mode='bcp', settings=None, outputs=(), by_path=False, retries=30):
+    query = {'mode': mode, 'wait': 1, 'name': os.path.basename(image_path), **(settings or {})}
+    if outputs:
+        query['outputs'] = ','.join(outputs)
+    if by_path:
+        data = json.dumps({'path': image_path}).encode()
+        content_type = 'application/json'
+    else:
+        with open(image_path, 'rb') as file:
+            data = file.read()
+        content_type = 'application/octet-stream'
+
+    for attempt in range(retries):
+        request = urllib.request.Request(f'{url}/jobs?{urllib.parse.urlencode(query)}', data=data,
+                                         headers={'Content-Type': content_type})
+        try:
+            with urllib.request.urlopen(request) as response:
+                status = json.load(response)
+            break
+        except urllib.error.HTTPError as error:
+            if error.code != 503 or attempt == retries - 1:
+                raise
+            time.sleep(float(error.headers.get('Retry-After', 1)))
+
+    for output in status.get('outputs', []):
+        with urllib.request.urlopen(url + output) as response:
+            status[output.rsplit('/', 1)[1].removesuffix('.png')] = response.read()
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local HTTP service for BCP/BTP phase fractions')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    serve_parser.add_argument('--capacity', type=int, default=16, help='jobs accepted at once before refusing with 503')
+    serve_parser.add_argument('--root', default='.', help='folder that path requests may read from')
+    serve_parser.add_argument('--max-upload-mb', type=int, default=512)
+    serve_parser.add_argument('--cache-dir')
+    serve_parser.add_argument('--low-memory', action='store_true')
+    serve_parser.add_argument('--verbose', action='store_true')
+
+    submit_parser = commands.add_parser('submit', help='send images to a running service')
+    submit_parser.add_argument('images', nargs='+')
+    submit_parser.add_argument('--url', default='http://127.0.0.1:8765')
+    submit_parser.add_argument('--mode', choices=sorted(phases), default='bcp')
+    submit_parser.add_argument('--by-path', action='store_true', help='send paths (under the service root) instead of uploads')
+    submit_parser.add_argument('--labels', help='folder to write label maps to')
+    submit_parser.add_argument('--overlay', help='folder to write overlays to')
+
+    metrics_parser = commands.add_parser('metrics')
+    metrics_parser.add_argument('--url', default='http://127.0.0.1:8765')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = make_server(args.host, args.port, args.workers, args.capacity, args.root, args.max_upload_mb,
+                             args.cache_dir, args.low_memory, args.verbose)
+        print(f'serving on http://{args.host}:{args.port} with {server.queue.workers} workers')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            server.queue.shutdown()
+    elif args.command == 'metrics':
+        with urllib.request.urlopen(f'{args.url}/metrics') as response:
+            print(json.dumps(json.load(response), indent=2))
+    else:
+        outputs = [name for name in ('labels', 'overlay') if getattr(args, name)]
+        for folder in (args.labels, args.overlay):
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+        for image_path in args.images:
+            status = submit_image(args.url, image_path, args.mode, outputs=outputs, by_path=args.by_path)
+            print(f"{os.path.basename(image_path)} - " +
+                  ', '.join(f'{phase.capitalize()}: {value:.2f}%' for phase, value in status['percentages'].items()))
+            stem = os.path.splitext(os.path.basename(image_path))[0]
+            for output in outputs:
+                with open(os.path.join(getattr(args, output), f'{stem}_{output}.png'), 'wb') as file:
+                    file.write(status[output])
@@ -0,0 +1,171 @@
+import argparse
+import csv
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from CVFunctions import detection_state, detection_selection, detection_labels, bcp_labels, btp_state, btp_corrections, \
+    btp_labels, load_clicks, load_parameters, save_parameters
+from ImageSource import open_image
+from ParameterSweep import parse_values, phase_columns
+from batch import init_worker
+
+#automatic tuning of boron_sensitivity, boron_detection_threshold and radius_inflation against
+#a few reference images, replacing hand adjustment of the gui sliders
+#references are phase fractions (a csv with an image column and the percentage columns of the
+#mode, e.g. image,boron,carbon,polymer) and/or reference masks: label pngs of the cropped image
+#(scale bar removed) with the phase labels of CVFunctions (0 unassigned, 1 boron, 2 carbon,
+#3 polymer, 4 tungsten), as written by TiledProcessing.py --labels; unassigned pixels are ignored
+#every setting of the grid is evaluated on the detections of each image, run once per sensitivity
+#(see detection_state), and each distinct circle selection is only labelled once. the grid scores
+#btp without corrections, so the best few settings are re-scored with the runs bcp/btp_headless
+#make (btp replaying each image's stored clicks), and the setting written is the best of those
+
+#reference fractions by image file name from a csv
+def load_reference_fractions(path, mode):
+    references = {}
+    with open(path, newline='') as table:
+        for row in csv.DictReader(table):
+            references[os.path.basename(row['image'])] = [float(row[column]) for column in phase_columns[mode]]
+    return references
+
+#path of the reference mask of an image (<stem>.png in masks_folder), or None
+def reference_mask_path(masks_folder, image_file):
+    if not masks_folder:
+        return None
+    path = os.path.join(masks_folder, os.path.splitext(image_file)[0] + '.png')
+    return path if os.path.exists(path) else None
+
+#image and reference mask of a reference image (mask None without a mask_path)
+def load_reference(image_path, mask_path=None):
+    image = open_image(image_path)
+    if image is None:
+        raise ValueError(f"could not read image: {image_path}")
+    mask = cv2.imread(mask_path, cv2.IMREAD_UNCHANGED) if mask_path else None
+    return image, mask
+
+#mean absolute difference of the percentages from the reference fractions (percentage points)
+#and/or the percentage of labelled reference pixels whose label differs, averaged
+def labels_error(image_file, labels, percentages, fractions=None, mask=None):
+    terms = []
+    if fractions is not None:
+        terms.append(np.mean(np.abs(np.array(percentages) - fractions)))
+    if mask is not None:
+        if mask.shape[:2] != labels.shape[:2]:
+            raise ValueError(f"reference mask of {image_file} does not match the cropped image")
+        labelled = mask > 0
+        terms.append(np.count_nonzero(labels[labelled] != mask[labelled]) / max(np.count_nonzero(labelled), 1) * 100)
+    return np.mean(terms)
+
+#error of every setting in grid on one image (see labels_error)
+def image_errors(image_path, mode, grid, fractions=None, mask_path=None, pyramid_levels=0):
+    image_file = os.path.basename(image_path)
+    image, mask = load_reference(image_path, mask_path)
+    state = detection_state(image_file, image, pyramid_levels)
+
+    error_of = {}
+    errors = np.zeros(len(grid))
+    for i, (sensitivity, detection_threshold, radius_inflation) in enumerate(grid):
+        boron, tungsten = detection_selection(state, mode, sensitivity, detection_threshold)
+        key = (boron.tobytes(), tungsten.tobytes(), radius_inflation)
+        if key not in error_of:
+            labels, percentages = detection_labels(state, mode, (boron, tungsten), radius_inflation)
+            error_of[key] = labels_error(image_file, labels, percentages, fractions, mask)
+        errors[i] = error_of[key]
+    return errors
+
+#error of each setting on one image with the full pipeline: bcp, or btp with the image's stored
+#clicks replayed as btp_headless does
+def image_run_errors(image_path, mode, settings, fractions=None, mask_path=None, pyramid_levels=0):
+    image_file = os.path.basename(image_path)
+    image, mask = load_reference(image_path, mask_path)
+    clicks_array = load_clicks(image_path) if mode == 'btp' else None
+
+    errors = np.zeros(len(settings))
+    for i, (sensitivity, detection_threshold, radius_inflation) in enumerate(settings):
+        if mode == 'bcp':
+            labels, percentages = bcp_labels(image_file, image, sensitivity, detection_threshold, radius_inflation,
+                                             pyramid_levels)
+        else:
+            state = btp_state(image_file, image, sensitivity, detection_threshold, radius_inflation, pyramid_levels)
+            if clicks_array is not None and len(clicks_array):
+                btp_corrections(state, clicks_array)
+            labels, percentages = btp_labels(state)
+        errors[i] = labels_error(image_file, labels, percentages, fractions, mask)
+    return errors
+
+#searches the grid for the settings with the lowest mean error over the reference images and
+#re-scores the best `rescore` of them with the full pipeline (see image_run_errors)
+#returns the best re-scored (boron_sensitivity, boron_detection_threshold, radius_inflation), its
+#full pipeline error, the mean grid error of every setting in grid order and the re-scored
+#settings as (setting, grid error, full pipeline error), best first
+def tune(image_paths, mode='bcp', sensitivities=range(1, 31), detection_thresholds=range(1, 51),
+         radius_inflations=(1.0,), fractions=None, masks_folder=None, pyramid_levels=0, workers=None, cache_dir=None,
+         rescore=5):
+    fractions = fractions or {}
+    grid = list(itertools.product(sensitivities, detection_thresholds, radius_inflations))
+
+    jobs = []
+    for image_path in image_paths:
+        image_file = os.path.basename(image_path)
+        mask_path = reference_mask_path(masks_folder, image_file)
+        if image_file in fractions or mask_path:
+            jobs.append((image_path, fractions.get(image_file), mask_path))
+    if not jobs:
+        raise ValueError('none of the images has a reference fraction or mask')
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cache_dir,)) as executor:
+        futures = [executor.submit(image_errors, image_path, mode, grid, reference, mask_path, pyramid_levels)
+                   for image_path, reference, mask_path in jobs]
+        errors = np.mean([future.result() for future in futures], axis=0)
+
+        shortlist = [int(i) for i in np.argsort(errors, kind='stable')[:max(1, rescore)]]
+        settings = [grid[i] for i in shortlist]
+        futures = [executor.submit(image_run_errors, image_path, mode, settings, reference, mask_path, pyramid_levels)
+                   for image_path, reference, mask_path in jobs]
+        run_errors = np.mean([future.result() for future in futures], axis=0)
+
+    rescored = sorted(zip(settings, errors[shortlist], run_errors), key=lambda item: item[2])
+    best_setting, _, best_error = rescored[0]
+    return best_setting, best_error, errors, rescored
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune detection parameters against reference fractions or masks')
+    parser.add_argument('images', nargs='+', help='reference images')
+    parser.add_argument('--mode', choices=['bcp', 'btp'], default='bcp')
+    parser.add_argument('--fractions', help='csv of reference percentages (image plus the phase columns of the mode)')
+    parser.add_argument('--masks', help='folder of reference label masks named after the images (<stem>.png)')
+    parser.add_argument('--sensitivity', default='1:30', help="boron_sensitivity values, e.g. '5:20' or '8,10,12'")
+    parser.add_argument('--threshold', default='1:50', help='boron_detection_threshold values')
+    parser.add_argument('--inflation', default='0.9:1.1:0.05', help='radius_inflation values')
+    parser.add_argument('--parameters', default='Parameters.txt', help='parameters file the best values are written to')
+    parser.add_argument('--rescore', type=int, default=5,
+                        help='number of best grid settings re-scored with full bcp/btp runs')
+    parser.add_argument('--dry-run', action='store_true', help='report the best values without writing them')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--cache-dir', help='on-disk cache of intermediate stages, reused across runs')
+    args = parser.parse_args()
+
+    if not args.fractions and not args.masks:
+        parser.error('give reference --fractions and/or --masks')
+
+    params = load_parameters(args.parameters) if os.path.exists(args.parameters) else {}
+    fractions = load_reference_fractions(args.fractions, args.mode) if args.fractions else None
+    (sensitivity, detection_threshold, radius_inflation), error, errors, rescored = tune(
+        args.images, args.mode, parse_values(args.sensitivity), parse_values(args.threshold),
+        [round(value, 4) for value in parse_values(args.inflation, float)], fractions, args.masks,
+        int(params.get('pyramid_levels', 0)), args.workers, args.cache_dir, args.rescore)
+
+    print(f"{'sensitivity':>11} {'threshold':>9} {'inflation':>9} {'grid error':>10} {'run error':>9}")
+    for setting, grid_error, run_error in rescored:
+        print(f'{setting[0]:>11} {setting[1]:>9} {setting[2]:>9} {grid_error:>10.2f} {run_error:>9.2f}')
+    print(f'best: boron_sensitivity = {sensitivity}, boron_detection_threshold = {detection_threshold}, '
+          f'radius_inflation = {radius_inflation} (mean error of the full runs {error:.2f})')
+    if not args.dry_run:
+        save_parameters(args.parameters, {'radius_inflation': radius_inflation, 'boron_sensitivity': sensitivity,
+                                          'boron_detection_threshold': detection_threshold})
+        print(f'written to {args.parameters}')
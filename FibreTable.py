@@ -0,0 +1,194 @@
+import argparse
+import csv
+import os
+import time
+
+import cv2
+import numpy as np
+
+from CVFunctions import load_parameters, crop_scale_bar, radius_band, detection_stages, btp_state, btp_corrections, \
+    load_clicks, profile_stage
+from ImageSource import open_image
+from batch import batch_settings, list_images
+
+#per-fibre measurements of the accepted boron (and tungsten) circles of an image: centre, radius, mean
+#gray and blue level inside the circle, nearest neighbour distance and gap, neighbour count and local fibre
+#volume fraction. tables are dicts of numpy columns, so they stack and export as columnar data
+#the neighbour metrics use scipy's kd-tree when scipy is installed and a chunked numpy search otherwise;
+#both give the same values. neighbours are counted over all accepted fibres, boron and tungsten together
+#the local volume fraction of a fibre is the area of the fibres centred within `neighbourhood` radii
+#(median fibre radius) of it, over the area of that window that lies inside the cropped image
+
+columns = ['phase', 'x', 'y', 'radius', 'mean_brightness', 'mean_blue', 'nn_distance', 'nn_gap', 'nn_index',
+           'neighbours', 'local_vf']
+
+#points on a disk of radius 1 (golden angle spiral), used to measure how much of a window is inside the image
+disk_samples = 256
+sample_angles = np.arange(disk_samples) * np.pi * (3 - np.sqrt(5))
+sample_radii = np.sqrt((np.arange(disk_samples) + 0.5) / disk_samples)
+disk_points = np.column_stack([sample_radii * np.cos(sample_angles), sample_radii * np.sin(sample_angles)])
+
+#fraction of the disk of the given radius around each point that lies inside an image of this shape
+def window_coverage(points, radius, shape):
+    height, width = shape[:2]
+    samples = points[:, None, :] + radius * disk_points[None, :, :]
+    inside = (samples[..., 0] >= 0) & (samples[..., 0] < width) & (samples[..., 1] >= 0) & (samples[..., 1] < height)
+    return inside.mean(axis=1)
+
+#nearest neighbour (distance, index) and, for every point, the count and summed weight of the other
+#points within radius; the kd-tree path, None when scipy is not installed
+def neighbours_kdtree(points, radius, weights):
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        return None
+
+    tree = cKDTree(points)
+    distance, index = tree.query(points, k=2)
+    pairs = tree.query_pairs(radius, output_type='ndarray')
+    n = len(points)
+    count = np.bincount(pairs[:, 0], minlength=n) + np.bincount(pairs[:, 1], minlength=n)
+    weight = np.bincount(pairs[:, 0], weights=weights[pairs[:, 1]], minlength=n) + \
+        np.bincount(pairs[:, 1], weights=weights[pairs[:, 0]], minlength=n)
+    return distance[:, 1], index[:, 1], count, weight
+
+#the same as neighbours_kdtree by brute force over blocks of rows, bounding the distance matrix to
+#about chunk_pairs entries
+def neighbours_numpy(points, radius, weights, chunk_pairs=4000000):
+    n = len(points)
+    distance = np.empty(n)
+    index = np.empty(n, dtype=np.int64)
+    count = np.empty(n, dtype=np.int64)
+    weight = np.empty(n)
+    chunk = max(1, chunk_pairs // n)
+    for start in range(0, n, chunk):
+        rows = np.arange(start, min(n, start + chunk))
+        d2 = np.sum((points[rows, None, :] - points[None, :, :])**2, axis=2)
+        d2[np.arange(len(rows)), rows] = np.inf
+        index[rows] = np.argmin(d2, axis=1)
+        distance[rows] = np.sqrt(d2[np.arange(len(rows)), index[rows]])
+        within = d2 <= radius**2
+        count[rows] = within.sum(axis=1)
+        weight[rows] = within @ weights
+    return distance, index, count, weight
+
+#columnar fibre table from circles (x, y, r), their phase names and brightness statistics
+#shape is the cropped image shape; backend is 'auto' (kd-tree when available), 'kdtree' or 'numpy'
+def fibre_table(circles, phases, avg_brightnesses, avg_blue_brightnesses, shape, neighbourhood=3.0, backend='auto'):
+    circles = np.asarray(circles, dtype=np.float64).reshape(-1, 3)
+    n = len(circles)
+    table = {'phase': np.asarray(phases, dtype=object), 'x': circles[:, 0], 'y': circles[:, 1], 'radius': circles[:, 2],
+             'mean_brightness': np.asarray(avg_brightnesses, dtype=np.float64),
+             'mean_blue': np.asarray(avg_blue_brightnesses, dtype=np.float64)}
+    if n < 2:
+        table.update(nn_distance=np.full(n, np.nan), nn_gap=np.full(n, np.nan), nn_index=np.full(n, -1),
+                     neighbours=np.zeros(n, dtype=np.int64), local_vf=np.full(n, np.nan))
+        return table
+
+    points = circles[:, :2]
+    area = np.pi * circles[:, 2]**2
+    window = neighbourhood * np.median(circles[:, 2])
+
+    result = neighbours_kdtree(points, window, area) if backend in ('auto', 'kdtree') else None
+    if result is None:
+        if backend == 'kdtree':
+            raise RuntimeError('the kd-tree backend needs scipy')
+        result = neighbours_numpy(points, window, area)
+    distance, index, count, weight = result
+
+    table['nn_distance'] = distance
+    table['nn_gap'] = distance - circles[:, 2] - circles[index, 2]
+    table['nn_index'] = index.astype(np.int64)
+    table['neighbours'] = count.astype(np.int64)
+    table['local_vf'] = (weight + area) / (np.pi * window**2 * window_coverage(points, window, shape))
+    return table
+
+#detects the accepted fibres of an image as bcp/btp do and returns their table
+#for btp, clicks (or the image's stored clicks, see load_clicks) move the clicked circles to tungsten
+def image_fibres(image_file, image, mode='bcp', boron_sensitivity=10, boron_detection_threshold=20, radius_inflation=1,
+                 pyramid_levels=0, clicks_array=None, neighbourhood=3.0, backend='auto'):
+    if mode == 'bcp':
+        cropped_image = crop_scale_bar(image)
+        gray = cv2.cvtColor(cropped_image, cv2.COLOR_BGR2GRAY)
+        (_, boronThreshold), circles, avg_brightnesses, avg_blue_brightnesses, _ = detection_stages(
+            cropped_image, gray, *radius_band(image_file, gray), boron_sensitivity, pyramid_levels)
+        if circles is None:
+            circles, avg_brightnesses, avg_blue_brightnesses = np.zeros((0, 3)), np.zeros(0), np.zeros(0)
+        else:
+            circles = circles[0]
+        selection = avg_brightnesses > boronThreshold - boron_detection_threshold
+        phases = np.full(np.count_nonzero(selection), 'boron', dtype=object)
+    else:
+        state = btp_state(image_file, image, boron_sensitivity, boron_detection_threshold, radius_inflation,
+                          pyramid_levels)
+        if clicks_array is not None and len(clicks_array):
+            btp_corrections(state, clicks_array)
+        circles, gray = state['circles'], state['gray']
+        avg_brightnesses, avg_blue_brightnesses = state['avg_brightnesses'], state['avg_blue_brightnesses']
+        selection = state['boron'] | state['tungsten']
+        phases = np.where(state['tungsten'][selection], 'tungsten', 'boron').astype(object)
+
+    with profile_stage('fibre_table'):
+        return fibre_table(circles[selection], phases, avg_brightnesses[selection], avg_blue_brightnesses[selection],
+                           gray.shape, neighbourhood, backend)
+
+#stacks per image tables into one, with an image column first
+def stack_tables(tables):
+    stacked = {'image': np.concatenate([np.full(len(table['x']), image, dtype=object) for image, table in tables])
+               if tables else np.zeros(0, dtype=object)}
+    for column in columns:
+        stacked[column] = np.concatenate([table[column] for _, table in tables]) if tables else np.zeros(0)
+    return stacked
+
+#writes a stacked table as parquet (needs pandas), compressed npz (one array per column) or csv
+def write_fibres(table, path):
+    if path.lower().endswith('.parquet'):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise RuntimeError('writing parquet needs pandas; use a .npz or .csv path instead')
+        pd.DataFrame(table).to_parquet(path, index=False)
+    elif path.lower().endswith('.npz'):
+        np.savez_compressed(path, **{name: values.astype(str) if values.dtype == object else values
+                                     for name, values in table.items()})
+    else:
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(list(table))
+            writer.writerows(zip(*table.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-fibre measurements of the accepted boron and tungsten circles')
+    parser.add_argument('images', nargs='+', help='image files or folders of images')
+    parser.add_argument('--mode', choices=['bcp', 'btp'], default='bcp')
+    parser.add_argument('--parameters', default='Parameters.txt')
+    parser.add_argument('--neighbourhood', type=float, default=3.0,
+                        help='local volume fraction window, in median fibre radii')
+    parser.add_argument('--backend', choices=['auto', 'kdtree', 'numpy'], default='auto')
+    parser.add_argument('--output', default='fibres.csv', help='.parquet (needs pandas), .npz or .csv')
+    args = parser.parse_args()
+
+    settings = batch_settings(load_parameters(args.parameters))
+    image_paths = []
+    for path in args.images:
+        image_paths.extend([os.path.join(path, f) for f in list_images(path)] if os.path.isdir(path) else [path])
+
+    tables = []
+    for image_path in image_paths:
+        image = open_image(image_path)
+        if image is None:
+            print(f'{image_path}: could not read image')
+            continue
+        start = time.perf_counter()
+        table = image_fibres(os.path.basename(image_path), image, args.mode, **settings,
+                             clicks_array=load_clicks(image_path) if args.mode == 'btp' else None,
+                             neighbourhood=args.neighbourhood, backend=args.backend)
+        tables.append((os.path.basename(image_path), table))
+        print(f"{os.path.basename(image_path)}: {len(table['x'])} fibres, median spacing "
+              f"{np.nanmedian(table['nn_distance']) if len(table['x']) > 1 else float('nan'):.1f} px, mean local vf "
+              f"{np.nanmean(table['local_vf']) if len(table['x']) > 1 else float('nan'):.3f} "
+              f"({time.perf_counter() - start:.2f} s)")
+
+    write_fibres(stack_tables(tables), args.output)
+    print(f'written to {args.output}')
@@ -2,9 +2,19 @@ import flet as ft
 import cv2
 import numpy as np
 import base64
-import tkinter as tk
-from tkinter import filedialog
-from CVFunctions import find_thresholds, bcp, btp
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import CVFunctions
+from CVFunctions import find_thresholds, bcp, btp_state, btp_render, btp_corrections, correction_window, RunCancelled, \
+    preview_state, has_detections, bcp_preview, btp_preview, save_clicks
+from PipelineCache import PipelineCache
+from ImageSource import open_image
+
+#keep thresholds, hough candidates and circle statistics between button presses so
+#slider changes only rerun the stages that depend on them
+CVFunctions.stage_cache = PipelineCache(max_entries=64)
 
 globalImage = None
 globalFilePath = ""
@@ -12,13 +22,74 @@ percentages_text = ""
 boron_sensitivity = 10
 boron_detection_threshold = 20
 
+#bcp/btp run on one background thread so the window stays responsive; opencv releases the
+#gil, and the stage cache and btp state stay in this process
+executor = ThreadPoolExecutor(max_workers=1)
+
+#the btp correction window runs on a thread of its own, so the worker stays free for later runs while
+#it is open; flet keeps the main thread, so every opencv window call is made from this one thread
+correction_executor = ThreadPoolExecutor(max_workers=1)
+
+#one background processing run; cancelling it makes its next progress report raise
+#RunCancelled, so it stops at the next stage boundary
+#kind is 'process' for a full bcp/btp run and 'preview' for building the live preview state or
+#detecting circles at a new sensitivity
+class BackgroundRun:
+    def __init__(self, on_progress, kind='process'):
+        self.on_progress = on_progress
+        self.kind = kind
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def progress(self, stage, fraction):
+        if self.cancelled.is_set():
+            raise RunCancelled(stage)
+        self.on_progress(self, stage, fraction)
+
+#widget size of the source and result images; display_zoom scales the frames sent to it
+#(e.g. 2 for high-dpi screens)
+display_size = (640, 480)
+display_zoom = 1.0
+display_quality = 85
+
+#encoded display frames, least recently used first
+frame_cache = OrderedDict()
+frame_cache_entries = 32
+frame_lock = threading.Lock()
+
+#image scaled down (never up) to the display size and sent as a base64 jpeg; encoding the
+#full resolution as png made every update slow, so full resolution is only used by Save Image
 def to_base64(image):
-    base64_image = cv2.imencode('.png', image)[1]
-    base64_image = base64.b64encode(base64_image).decode('utf-8') 
+    height, width = image.shape[:2]
+    scale = min(1.0, display_size[0] * display_zoom / width, display_size[1] * display_zoom / height)
+    if scale < 1:
+        size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    base64_image = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, display_quality])[1]
+    base64_image = base64.b64encode(base64_image).decode('utf-8')
     return base64_image
 
+#returns make() cached under key, for frames that are shown again (the source image, preview
+#redraws at slider positions already visited)
+def cached_frame(key, make):
+    with frame_lock:
+        if key in frame_cache:
+            frame_cache.move_to_end(key)
+            return frame_cache[key]
+    value = make()
+    with frame_lock:
+        frame_cache[key] = value
+        while len(frame_cache) > frame_cache_entries:
+            frame_cache.popitem(last=False)
+    return value
+
+#tkinter is only needed for the save dialog, so it is imported here rather than at start-up
 def save_image_action(e):
-    
+    import tkinter as tk
+    from tkinter import filedialog
+
     root = tk.Tk()
     root.withdraw()  # Hide the root window
     file_path = filedialog.asksaveasfilename(
@@ -44,6 +115,92 @@ def main(page):
 
     image = None
     percentages_field = ft.TextField(value="", width=1000, read_only=True, border_color='blue')
+    progress_bar = ft.ProgressBar(width=640, value=0)
+    status_text = ft.Text("")
+
+    #only the latest run may update the window; starting a run, changing a slider or picking a
+    #new file cancels the one before it, and results of a stale run are dropped
+    current_run = None
+    run_lock = threading.Lock()
+
+    #live preview: built once per image in the background; hough runs in the background once for each
+    #sensitivity, and slider positions whose sensitivity is already detected are redrawn directly
+    preview = None
+    preview_generation = 0
+    preview_mode = 'bcp'
+    preview_lock = threading.Lock()
+    live_preview = ft.Checkbox(label="Live preview", value=False, on_change=lambda e: start_preview())
+
+    def show_progress(run, stage, fraction):
+        with run_lock:
+            if run is not current_run:
+                return
+        progress_bar.value = fraction
+        status_text.value = f"Running: {stage}"
+        progress_bar.update()
+        status_text.update()
+
+    #cancels the current run; with kind, only if the current run is of that kind
+    def cancel_run(kind=None):
+        nonlocal current_run
+        with run_lock:
+            run = current_run
+            if run is None or (kind is not None and run.kind != kind):
+                return
+            current_run = None
+        if run is not None:
+            run.cancel()
+            progress_bar.value = 0
+            status_text.value = "Cancelled"
+            progress_bar.update()
+            status_text.update()
+
+    #runs process(run) on the background thread; process returns (overlay image, percentages text), or
+    #None when it has handed the run on to another step (see BTPMain)
+    def start_run(process, kind='process'):
+        nonlocal current_run
+        cancel_run()
+        run = BackgroundRun(show_progress, kind)
+        with run_lock:
+            current_run = run
+        executor.submit(finish_run, run, process)
+
+    def finish_run(run, process):
+        nonlocal current_run
+        global globalImage
+        try:
+            result = process(run)
+            if result is None:
+                return
+            processed, percentages_text = result
+            base64_image = to_base64(processed)
+        except RunCancelled:
+            return
+        except Exception as error:
+            with run_lock:
+                if run is not current_run:
+                    return
+                current_run = None
+            status_text.value = f"Failed: {error}"
+            status_text.update()
+            return
+
+        with run_lock:
+            if run is not current_run:
+                return
+            current_run = None
+
+        #previews are scaled down; Save Image keeps the last full resolution result
+        if run.kind == 'process':
+            globalImage = processed
+        image_dst.src_base64 = base64_image
+        image_dst.update()
+        percentages_field.value = percentages_text
+        percentages_field.update()
+        progress_bar.value = 1
+        status_text.value = "Done"
+        progress_bar.update()
+        status_text.update()
 
     # Slider components
     slider_boron_sensitivity = ft.Slider(
@@ -59,57 +216,134 @@ def main(page):
         global boron_sensitivity, boron_detection_threshold
         boron_sensitivity = slider_boron_sensitivity.value
         boron_detection_threshold = slider_boron_detection_threshold.value
+        #a processing run is dropped; a preview run is replaced by one at the new slider values
+        cancel_run('process')
         print(f"Global variables updated: Boron Sensitivity = {boron_sensitivity}, Boron Detection Threshold = {boron_detection_threshold}")
+        start_preview()
 
-    def BTPMain(e):
-        nonlocal image
-        global globalImage, boron_sensitivity, boron_detection_threshold
-        revised = False
-        clicks_array = None
+    #overlay and approximate percentages of the current mode at the given slider values
+    def render_preview(state, sensitivity, detection_threshold, progress=None):
+        render = bcp_preview if preview_mode == 'bcp' else btp_preview
+        processed, percentages = render(state, sensitivity, detection_threshold, progress=progress)
+        names = ['Boron', 'Carbon', 'Polymer'] if preview_mode == 'bcp' else ['Boron', 'Tungsten', 'Polymer']
+        text = ', '.join(f"{name}: {value:.2f}%" for name, value in zip(names, percentages))
+        return processed, f"Preview - {text}"
 
+    #redraws the live preview from the cached state and detections; no pipeline stage is rerun
+    def draw_preview():
+        if not live_preview.value or preview is None:
+            return
+        with preview_lock:
+            key = ('preview', preview_generation, preview_mode, boron_sensitivity, boron_detection_threshold)
+
+            def make():
+                processed, percentages_text = render_preview(preview, boron_sensitivity, boron_detection_threshold)
+                return to_base64(processed), percentages_text
+
+            image_dst.src_base64, percentages_text = cached_frame(key, make)
+            image_dst.update()
+            percentages_field.value = percentages_text
+            percentages_field.update()
+
+    #draws the live preview; building its state or detecting circles at a new sensitivity is done
+    #in the background first
+    def start_preview():
+        if not live_preview.value or image is None:
+            return
+        if preview is not None and has_detections(preview, boron_sensitivity):
+            #a preview run still detecting an earlier sensitivity would overwrite this frame when it finishes
+            cancel_run('preview')
+            draw_preview()
+            return
+
+        run_image, file_path, state = image, globalFilePath, preview
+        sensitivity, detection_threshold = boron_sensitivity, boron_detection_threshold
+
+        def process(run):
+            nonlocal preview, preview_generation
+            built = state
+            if built is None:
+                built = preview_state(file_path, run_image, progress=run.progress)
+                with run_lock:
+                    if run is current_run:
+                        preview = built
+                        preview_generation += 1
+            return render_preview(built, sensitivity, detection_threshold, run.progress)
+
+        start_run(process, kind='preview')
+
+    def BTPMain(e):
+        nonlocal image, preview_mode
+        preview_mode = 'btp'
         if image is None:
             return
-        
-        revised, clicks_array, processed, percentages = btp(clicks_array, globalFilePath, image, boron_sensitivity, boron_detection_threshold)
-        if revised: _, _, processed, percentages = btp(clicks_array, globalFilePath, image, boron_sensitivity, boron_detection_threshold)
 
-        percentages_text = f"Boron: {percentages[0]}%, Tungsten: {percentages[1]}%, Polymer: {percentages[2]}%"
+        #inputs are captured now so later slider or file changes do not leak into this run
+        run_image, file_path = image, globalFilePath
+        sensitivity, detection_threshold = boron_sensitivity, boron_detection_threshold
 
-        globalImage = processed
-        base64_image = to_base64(globalImage)
-        image_dst.src_base64 = base64_image
-        image_dst.update()
-        percentages_field.value = percentages_text
-        percentages_field.update()
+        #the first pass runs on the worker, the correction window on its own thread and the correction
+        #pass back on the worker; cancelling the run (Cancel, a slider or a new file) closes the window
+        def process(run):
+            state = btp_state(file_path, run_image, sensitivity, detection_threshold, progress=run.progress)
+            run.progress('render', 0.85)
+            processed, percentages = btp_render(state)
+            run.progress('corrections', 0.9)
+            correction_executor.submit(finish_run, run, lambda run: correct(run, state, processed, percentages))
+
+        def correct(run, state, processed, percentages):
+            clicks_array, done = correction_window(processed, run.cancelled.is_set)
+            #stored next to the image so batch.py --mode btp can replay the corrections headlessly; saved
+            #even when the run is cancelled while the window is open, so the clicks are not lost
+            if len(clicks_array):
+                save_clicks(file_path, clicks_array)
+            if not done:
+                raise RunCancelled('corrections')
+            executor.submit(finish_run, run, lambda run: apply_corrections(run, state, clicks_array, processed, percentages))
+
+        #the correction pass reuses the state of the first pass and only reclassifies what was clicked
+        def apply_corrections(run, state, clicks_array, processed, percentages):
+            if len(clicks_array):
+                run.progress('corrections', 0.95)
+                btp_corrections(state, clicks_array)
+                processed, percentages = btp_render(state)
+            return processed, f"Boron: {percentages[0]}%, Tungsten: {percentages[1]}%, Polymer: {percentages[2]}%"
+
+        start_run(process)
 
     def BCPMain(e):
-        global globalImage, boron_sensitivity, boron_detection_threshold
-        nonlocal image
+        nonlocal image, preview_mode
+        preview_mode = 'bcp'
         if image is None:
             return
 
+        run_image, file_path = image, globalFilePath
+        sensitivity, detection_threshold = boron_sensitivity, boron_detection_threshold
+
         # Pass slider values to bcp function if needed
-        processed, percentages = bcp(globalFilePath, image, boron_sensitivity, boron_detection_threshold)
-        percentages_text = f"Boron: {percentages[0]}%, Polymer: {percentages[1]}%, Carbon: {percentages[2]}%"
+        def process(run):
+            processed, percentages = bcp(file_path, run_image, sensitivity, detection_threshold, progress=run.progress)
+            return processed, f"Boron: {percentages[0]}%, Carbon: {percentages[1]}%, Polymer: {percentages[2]}%"
 
-        globalImage = processed
-        base64_image = to_base64(processed)
-        image_dst.src_base64 = base64_image
-        image_dst.update()
-        percentages_field.value = percentages_text
-        percentages_field.update()
+        start_run(process)
 
     def on_file_selected(e):
         global globalFilePath
-        nonlocal image
+        nonlocal image, preview
 
+        if not e.files:
+            return
+        cancel_run()
+        preview = None
         file_path = e.files[0].path
         globalFilePath = file_path
         print("file selected :", file_path)
-        image = cv2.imread(file_path)
-        base64_image = to_base64(image)
-        image_src.src_base64 = base64_image
+        #large tiffs are memory-mapped; bcp/btp only decode the region they process
+        image = open_image(file_path)
+        source_key = ('source', file_path, os.path.getmtime(file_path))
+        image_src.src_base64 = cached_frame(source_key, lambda: to_base64(np.asarray(image)))
         image_src.update()
+        start_preview()
 
     file_picker = ft.FilePicker(on_result=on_file_selected)
     page.overlay.append(file_picker)
@@ -123,12 +357,17 @@ def main(page):
     button_BTPMain = ft.ElevatedButton("BTP", on_click=BTPMain)
     button_BCPMain = ft.ElevatedButton("BCP", on_click=BCPMain)
     button_save_image = ft.ElevatedButton("Save Image", on_click=lambda e: save_image_action(e))
+    button_cancel = ft.ElevatedButton("Cancel", on_click=lambda e: cancel_run())
     
     page.add(button)
     page.add(image_row)
     page.add(button_BTPMain)
     page.add(button_BCPMain)
     page.add(button_save_image)
+    page.add(button_cancel)
+    page.add(live_preview)
+    page.add(progress_bar)
+    page.add(status_text)
     page.add(percentages_field)
     page.add(ft.Text("Boron Detection Threshold (1-50):"))
     page.add(slider_boron_detection_threshold)
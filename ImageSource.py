@@ -0,0 +1,204 @@
+import struct
+
+import cv2
+import numpy as np
+
+#image sources for bcp/btp and the tiled path
+#uncompressed 8-bit TIFF and BigTIFF files (stripped or tiled) are memory-mapped and decoded
+#region by region on slicing, so image[:int(height * 0.92), :] only reads the rows it keeps
+#and a tile only reads its own pixels; other formats are decoded eagerly with cv2.imread
+#sources behave like a read-only (height, width, 3) bgr uint8 array for 2-D slicing
+
+#tiff tags used by the reader
+IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, COMPRESSION = 256, 257, 258, 259
+PHOTOMETRIC, STRIP_OFFSETS, SAMPLES_PER_PIXEL, ROWS_PER_STRIP = 262, 273, 277, 278
+STRIP_BYTE_COUNTS, PLANAR_CONFIGURATION = 279, 284
+TILE_WIDTH, TILE_LENGTH, TILE_OFFSETS, TILE_BYTE_COUNTS = 322, 323, 324, 325
+
+#numpy type of the integer tiff field types (SHORT, LONG, LONG8, IFD8)
+tiff_field_types = {3: 'u2', 4: 'u4', 13: 'u4', 16: 'u8', 18: 'u8'}
+
+#raised for tiff files this reader cannot map (compressed, 16-bit, planar, ...)
+class UnsupportedTiff(ValueError):
+    pass
+
+#integer tags of the first image file directory of a classic or big tiff
+def read_tiff_tags(file):
+    header = file.read(16)
+    if header[:2] == b'II':
+        order = '<'
+    elif header[:2] == b'MM':
+        order = '>'
+    else:
+        raise UnsupportedTiff('not a tiff file')
+
+    #classic tiff: 2-byte entry count, 4-byte value counts and offsets; bigtiff: 8 bytes for all three
+    version = struct.unpack(order + 'H', header[2:4])[0]
+    if version == 42:
+        ifd_offset = struct.unpack(order + 'I', header[4:8])[0]
+        entry_count_format, value_format, entry_size = 'H', 'I', 12
+    elif version == 43:
+        ifd_offset = struct.unpack(order + 'Q', header[8:16])[0]
+        entry_count_format, value_format, entry_size = 'Q', 'Q', 20
+    else:
+        raise UnsupportedTiff('not a tiff file')
+
+    file.seek(ifd_offset)
+    entry_count_size = struct.calcsize(entry_count_format)
+    entry_count = struct.unpack(order + entry_count_format, file.read(entry_count_size))[0]
+    entries = file.read(entry_count * entry_size)
+    value_size = struct.calcsize(value_format)
+
+    tags = {}
+    for i in range(entry_count):
+        entry = entries[i * entry_size:(i + 1) * entry_size]
+        tag, field_type = struct.unpack(order + 'HH', entry[:4])
+        if field_type not in tiff_field_types:
+            continue
+        count = struct.unpack(order + value_format, entry[4:4 + value_size])[0]
+        dtype = np.dtype(tiff_field_types[field_type]).newbyteorder(order)
+        size = count * dtype.itemsize
+        value_field = entry[4 + value_size:]
+        if size <= value_size:
+            data = value_field[:size]
+        else:
+            position = file.tell()
+            file.seek(struct.unpack(order + value_format, value_field)[0])
+            data = file.read(size)
+            file.seek(position)
+        tags[tag] = np.frombuffer(data, dtype=dtype).astype(np.int64)
+    return tags
+
+#memory-mapped uncompressed 8-bit tiff/bigtiff (chunky gray, rgb or rgba; strips or tiles)
+class TiffSource:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            tags = read_tiff_tags(file)
+
+        def tag(code, default=None):
+            if code in tags:
+                return tags[code]
+            if default is None:
+                raise UnsupportedTiff(f'missing tiff tag {code}')
+            return np.array(default)
+
+        self.width = int(tag(IMAGE_WIDTH)[0])
+        self.height = int(tag(IMAGE_LENGTH)[0])
+        self.samples = int(tag(SAMPLES_PER_PIXEL, [1])[0])
+        self.photometric = int(tag(PHOTOMETRIC, [1])[0])
+
+        if int(tag(COMPRESSION, [1])[0]) != 1:
+            raise UnsupportedTiff('compressed tiff')
+        if np.any(tag(BITS_PER_SAMPLE, [8]) != 8):
+            raise UnsupportedTiff('only 8-bit tiff is mapped')
+        if self.samples > 1 and int(tag(PLANAR_CONFIGURATION, [1])[0]) != 1:
+            raise UnsupportedTiff('planar tiff')
+        if (self.samples, self.photometric) not in ((1, 0), (1, 1), (3, 2), (4, 2)):
+            raise UnsupportedTiff('unsupported colour layout')
+
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        self.tiled = TILE_OFFSETS in tags
+        if self.tiled:
+            self.tile_width = int(tag(TILE_WIDTH)[0])
+            self.tile_length = int(tag(TILE_LENGTH)[0])
+            self.offsets = tag(TILE_OFFSETS)
+        else:
+            self.rows_per_strip = min(int(tag(ROWS_PER_STRIP, [self.height])[0]), self.height)
+            self.offsets = tag(STRIP_OFFSETS)
+            counts = tag(STRIP_BYTE_COUNTS)
+            row_bytes = self.width * self.samples
+
+            #strips written back to back are viewed as one (height, width, samples) array
+            self.contiguous = None
+            if np.all(self.offsets[1:] == self.offsets[:-1] + counts[:-1]) and \
+                    self.offsets[0] + self.height * row_bytes <= self.data.size:
+                self.contiguous = self.data[self.offsets[0]:self.offsets[0] + self.height * row_bytes] \
+                    .reshape(self.height, self.width, self.samples)
+
+    @property
+    def shape(self):
+        return (self.height, self.width, 3)
+
+    dtype = np.dtype(np.uint8)
+    ndim = 3
+
+    #raw samples of rows y0:y1, columns x0:x1
+    def read_raw(self, y0, y1, x0, x1):
+        if not self.tiled and self.contiguous is not None:
+            return self.contiguous[y0:y1, x0:x1]
+
+        region = np.empty((y1 - y0, x1 - x0, self.samples), dtype=np.uint8)
+        if self.tiled:
+            tiles_across = -(-self.width // self.tile_width)
+            tile_bytes = self.tile_length * self.tile_width * self.samples
+            for ty in range(y0 // self.tile_length, -(-y1 // self.tile_length)):
+                for tx in range(x0 // self.tile_width, -(-x1 // self.tile_width)):
+                    offset = self.offsets[ty * tiles_across + tx]
+                    tile = self.data[offset:offset + tile_bytes].reshape(self.tile_length, self.tile_width, self.samples)
+                    ty0, tx0 = ty * self.tile_length, tx * self.tile_width
+                    ys = slice(max(y0, ty0), min(y1, ty0 + self.tile_length))
+                    xs = slice(max(x0, tx0), min(x1, tx0 + self.tile_width))
+                    region[ys.start - y0:ys.stop - y0, xs.start - x0:xs.stop - x0] = \
+                        tile[ys.start - ty0:ys.stop - ty0, xs.start - tx0:xs.stop - tx0]
+        else:
+            row_bytes = self.width * self.samples
+            for strip in range(y0 // self.rows_per_strip, -(-y1 // self.rows_per_strip)):
+                sy0 = strip * self.rows_per_strip
+                rows = min(self.rows_per_strip, self.height - sy0)
+                offset = self.offsets[strip]
+                block = self.data[offset:offset + rows * row_bytes].reshape(rows, self.width, self.samples)
+                ys = slice(max(y0, sy0), min(y1, sy0 + rows))
+                region[ys.start - y0:ys.stop - y0] = block[ys.start - sy0:ys.stop - sy0, x0:x1]
+        return region
+
+    #decoded bgr region; only the strips or tiles that overlap it are touched
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) > 2 and key[2] != slice(None):
+            raise TypeError('only row and column slices are supported')
+        (y0, y1, ystep), (x0, x1, xstep) = key[0].indices(self.height), key[1].indices(self.width)
+        if ystep != 1 or xstep != 1:
+            raise TypeError('only unit-step slices are supported')
+        y1, x1 = max(y0, y1), max(x0, x1)
+
+        raw = self.read_raw(y0, y1, x0, x1)
+        if self.samples == 1:
+            gray = raw[:, :, 0] if self.photometric == 1 else 255 - raw[:, :, 0]
+            return cv2.cvtColor(np.ascontiguousarray(gray), cv2.COLOR_GRAY2BGR)
+        return np.ascontiguousarray(raw[:, :, 2::-1])
+
+    def __array__(self, dtype=None, copy=None):
+        image = self[:, :]
+        return image if dtype is None else image.astype(dtype)
+
+#optional tifffile reader for tiffs the mapped reader does not handle; None when unavailable
+def read_with_tifffile(path):
+    try:
+        import tifffile
+    except ImportError:
+        return None
+
+    image = tifffile.imread(path)
+    if image.dtype != np.uint8:
+        return None
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.ndim == 3 and image.shape[2] in (3, 4):
+        return np.ascontiguousarray(image[:, :, 2::-1])
+    return None
+
+#opens an image for processing: a memory-mapped TiffSource for uncompressed tiff/bigtiff,
+#otherwise a decoded bgr array (tifffile for other tiffs when installed, then cv2.imread)
+#returns None when the file cannot be read, like cv2.imread
+def open_image(path):
+    if path.lower().endswith(('.tif', '.tiff')):
+        try:
+            return TiffSource(path)
+        except (UnsupportedTiff, OSError, ValueError, struct.error):
+            pass
+        image = read_with_tifffile(path)
+        if image is not None:
+            return image
+    return cv2.imread(path)
@@ -0,0 +1,124 @@
+import argparse
+import csv
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from CVFunctions import detection_state, detection_selection, detection_labels
+from ImageSource import open_image
+from batch import list_images, init_worker
+
+#percentages of bcp/btp over a grid of boron_sensitivity, boron_detection_threshold and
+#radius_inflation values for a set of images
+#each image is loaded and thresholded once, hough, the circle statistics and the blue threshold
+#run once per sensitivity (see detection_state) and are shared by every threshold and inflation,
+#and a label map is only built for each distinct circle selection, so every cell is exactly the
+#bcp/btp (without corrections) result at its setting
+#images run in parallel worker processes; the result is one row per image and setting
+
+#phase columns of each mode, in the order bcp/btp return the percentages
+phase_columns = {'bcp': ['boron', 'carbon', 'polymer'], 'btp': ['boron', 'tungsten', 'polymer']}
+
+#values of a grid axis: '5,10,15' or an inclusive range 'start:stop[:step]'
+def parse_values(text, type=int):
+    values = []
+    for part in text.split(','):
+        if ':' in part:
+            bounds = [type(value) for value in part.split(':')]
+            start, stop = bounds[0], bounds[1]
+            step = bounds[2] if len(bounds) > 2 else type(1)
+            count = int(round((stop - start) / step)) + 1
+            values.extend(type(start + i * step) for i in range(max(count, 0)))
+        elif part.strip():
+            values.append(type(part))
+    return values
+
+#rows of percentages for every combination of the grid on one image
+def sweep_image(image_path, mode, sensitivities, detection_thresholds, radius_inflations=(1.0,), pyramid_levels=0):
+    image = open_image(image_path)
+    if image is None:
+        raise ValueError(f"could not read image: {image_path}")
+    image_file = os.path.basename(image_path)
+    state = detection_state(image_file, image, pyramid_levels)
+
+    percentages_of = {}
+    rows = []
+    for sensitivity, detection_threshold, radius_inflation in itertools.product(
+            sensitivities, detection_thresholds, radius_inflations):
+        boron, tungsten = detection_selection(state, mode, sensitivity, detection_threshold)
+        key = (boron.tobytes(), tungsten.tobytes(), radius_inflation)
+        if key not in percentages_of:
+            percentages_of[key] = detection_labels(state, mode, (boron, tungsten), radius_inflation)[1]
+
+        row = {'image': image_file, 'mode': mode, 'boron_sensitivity': sensitivity,
+               'boron_detection_threshold': detection_threshold, 'radius_inflation': radius_inflation,
+               'circles': len(boron) + len(tungsten)}
+        row.update(zip(phase_columns[mode], percentages_of[key]))
+        rows.append(row)
+    return rows
+
+#sweeps every image with a pool of worker processes; returns the rows in image order and the
+#images that failed with their errors
+def run_sweep(image_paths, mode='bcp', sensitivities=(10,), detection_thresholds=(20,), radius_inflations=(1.0,),
+              pyramid_levels=0, workers=None, cache_dir=None):
+    results = {}
+    errors = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cache_dir,)) as executor:
+        futures = {executor.submit(sweep_image, image_path, mode, sensitivities, detection_thresholds,
+                                   radius_inflations, pyramid_levels): image_path for image_path in image_paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            image_path = futures[future]
+            try:
+                results[image_path] = future.result()
+            except Exception as error:
+                errors[image_path] = error
+                print(f'[{done}/{len(image_paths)}] {image_path} failed: {error}')
+                continue
+            print(f'[{done}/{len(image_paths)}] {image_path} complete')
+
+    rows = [row for image_path in image_paths for row in results.get(image_path, [])]
+    return rows, errors
+
+#writes the rows as parquet (needs pandas with pyarrow or fastparquet) for a .parquet path,
+#otherwise as csv
+def write_table(rows, path, mode='bcp'):
+    columns = ['image', 'mode', 'boron_sensitivity', 'boron_detection_threshold', 'radius_inflation', 'circles'] \
+        + phase_columns[mode]
+    if path.lower().endswith('.parquet'):
+        try:
+            import pandas as pd
+        except ImportError:
+            raise RuntimeError('writing parquet needs pandas; use a .csv path instead')
+        pd.DataFrame(rows, columns=columns).to_parquet(path, index=False)
+        return
+
+    with open(path, 'w', newline='') as table:
+        writer = csv.DictWriter(table, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Phase percentages over a grid of detection parameters')
+    parser.add_argument('images', nargs='+', help='image files or folders of images')
+    parser.add_argument('--mode', choices=['bcp', 'btp'], default='bcp')
+    parser.add_argument('--sensitivity', default='1:30', help="boron_sensitivity values, e.g. '5:20' or '8,10,12'")
+    parser.add_argument('--threshold', default='1:50', help='boron_detection_threshold values')
+    parser.add_argument('--inflation', default='1.0', help='radius_inflation values')
+    parser.add_argument('--pyramid-levels', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--cache-dir', help='on-disk cache of intermediate stages, reused across runs')
+    parser.add_argument('--output', default='sweep.csv', help='.csv or .parquet table')
+    args = parser.parse_args()
+
+    image_paths = []
+    for path in args.images:
+        if os.path.isdir(path):
+            image_paths.extend(os.path.join(path, f) for f in list_images(path))
+        else:
+            image_paths.append(path)
+
+    rows, errors = run_sweep(image_paths, args.mode, parse_values(args.sensitivity), parse_values(args.threshold),
+                             parse_values(args.inflation, float), args.pyramid_levels, args.workers, args.cache_dir)
+    write_table(rows, args.output, args.mode)
+    print(f'{len(rows)} rows written to {args.output}, {len(errors)} images failed')
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+#content hash of an image array (pixels plus shape and dtype), used as the root of every cache key
+def image_digest(image):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((image.shape, image.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+#file name safe digest of an arbitrary cache key tuple
+def key_digest(key):
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+#cache of intermediate pipeline results (thresholds, hough candidates, circle statistics)
+#keyed on image content hash plus the parameters each stage depends on
+#entries are held in memory with an lru bound and, when cache_dir is given, also pickled to disk
+#so they survive between runs; cached values are shared, so callers must not modify them
+class PipelineCache:
+    def __init__(self, max_entries=64, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def disk_path(self, key):
+        return os.path.join(self.cache_dir, key_digest(key) + '.pkl')
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        if self.cache_dir and os.path.exists(self.disk_path(key)):
+            try:
+                with open(self.disk_path(key), 'rb') as file:
+                    value = pickle.load(file)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+            else:
+                self.put(key, value, write_disk=False)
+                with self.lock:
+                    self.hits += 1
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return default
+
+    def put(self, key, value, write_disk=True):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        if write_disk and self.cache_dir:
+            #write to a temporary name first so a concurrent reader never sees a partial file
+            path = self.disk_path(key)
+            temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as file:
+                pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+
+    #returns the cached value for key, computing and storing it on a miss
+    def get_or_compute(self, key, compute):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
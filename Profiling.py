@@ -0,0 +1,182 @@
+import argparse
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+#per-stage instrumentation of the detection pipeline
+#a PipelineProfiler records the wall time, cpu time and (with track_memory) peak traced memory
+#of every stage, plus candidate counts, grouped per image; each finished image is appended to
+#the output file as one json line, so several worker processes can share a file
+#CVFunctions reports its stages to CVFunctions.profiler when one is set; the summary functions
+#aggregate the json lines of a batch
+#cpu time is process wide and peak memory is what tracemalloc sees (numpy buffers, not opencv
+#internals); tracing memory slows the pipeline down, so it is off by default
+
+class PipelineProfiler:
+    def __init__(self, path=None, track_memory=False):
+        self.path = path
+        self.track_memory = track_memory
+        self.records = []
+        self.current = None
+        self.lock = threading.RLock()
+        self.started_tracing = False
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    #current traced memory, resetting the peak so the next reading covers only what follows
+    def memory_mark(self):
+        if not self.track_memory:
+            return 0
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return current
+
+    #peak traced memory since the last mark
+    def memory_peak(self):
+        return tracemalloc.get_traced_memory()[1] if self.track_memory else 0
+
+    def begin_image(self, image, **info):
+        with self.lock:
+            if self.current is not None:
+                self.end_image()
+            memory = self.memory_mark()
+            self.current = {'image': image, **info, 'stages': {}, 'counts': {},
+                            'start': (time.perf_counter(), time.process_time(), memory), 'peak': memory}
+            self.lap_start = self.current['start']
+
+    #record of the current image; stages reported outside an image go to an unnamed one
+    def record(self):
+        if self.current is None:
+            self.begin_image(None)
+        return self.current
+
+    def add_stage(self, name, wall, cpu, start_memory, peak):
+        with self.lock:
+            record = self.record()
+            stage = record['stages'].setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_bytes': 0})
+            stage['calls'] += 1
+            stage['wall_s'] += wall
+            stage['cpu_s'] += cpu
+            stage['peak_bytes'] = max(stage['peak_bytes'], peak - start_memory)
+            record['peak'] = max(record['peak'], peak)
+            self.lap_start = (time.perf_counter(), time.process_time(), self.memory_mark())
+
+    @contextmanager
+    def stage(self, name):
+        with self.lock:
+            self.record()
+        wall, cpu, memory = time.perf_counter(), time.process_time(), self.memory_mark()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - wall, time.process_time() - cpu, memory, self.memory_peak())
+
+    #records everything since the previous lap, stage or image start as stage name; for
+    #straight-line scripts that cannot wrap their steps in a with block
+    def lap(self, name):
+        with self.lock:
+            self.record()
+            wall, cpu, memory = self.lap_start
+            self.add_stage(name, time.perf_counter() - wall, time.process_time() - cpu, memory, self.memory_peak())
+
+    def count(self, name, value):
+        with self.lock:
+            counts = self.record()['counts']
+            counts[name] = counts.get(name, 0) + int(value)
+
+    def end_image(self):
+        with self.lock:
+            if self.current is None:
+                return None
+            record = self.current
+            self.current = None
+
+            wall, cpu, memory = record.pop('start')
+            peak = max(record.pop('peak'), self.memory_peak())
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = time.process_time() - cpu
+            record['peak_bytes'] = peak - memory if self.track_memory else None
+            self.records.append(record)
+
+            if self.path:
+                with open(self.path, 'a') as file:
+                    file.write(json.dumps(record) + '\n')
+            return record
+
+    @contextmanager
+    def image(self, image, **info):
+        self.begin_image(image, **info)
+        try:
+            yield
+        finally:
+            self.end_image()
+
+    def close(self):
+        self.end_image()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+#records from a json lines file written by PipelineProfiler
+def load_records(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+#aggregates per image records: totals and per call means of every stage with its share of the
+#total wall time, the largest stage peak memory, and totals, means and maxima of every count
+def summarize(records):
+    stages = {}
+    counts = {}
+    total_wall = sum(record['wall_s'] for record in records)
+    for record in records:
+        for name, stage in record['stages'].items():
+            total = stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'max_wall_s': 0.0, 'peak_bytes': 0})
+            total['calls'] += stage['calls']
+            total['wall_s'] += stage['wall_s']
+            total['cpu_s'] += stage['cpu_s']
+            total['max_wall_s'] = max(total['max_wall_s'], stage['wall_s'])
+            total['peak_bytes'] = max(total['peak_bytes'], stage['peak_bytes'])
+        for name, value in record['counts'].items():
+            counts.setdefault(name, []).append(value)
+
+    for stage in stages.values():
+        stage['mean_wall_s'] = stage['wall_s'] / stage['calls']
+        stage['share'] = stage['wall_s'] / total_wall if total_wall > 0 else 0.0
+
+    peaks = [record['peak_bytes'] for record in records if record.get('peak_bytes') is not None]
+    return {
+        'images': len(records),
+        'wall_s': total_wall,
+        'cpu_s': sum(record['cpu_s'] for record in records),
+        'peak_bytes': max(peaks) if peaks else None,
+        'stages': stages,
+        'counts': {name: {'total': sum(values), 'mean': sum(values) / len(values), 'max': max(values)}
+                   for name, values in counts.items()},
+    }
+
+#summary as a text report, stages ordered by total wall time
+def format_summary(summary):
+    lines = [f"{summary['images']} images, {summary['wall_s']:.2f} s wall, {summary['cpu_s']:.2f} s cpu"
+             + (f", peak {summary['peak_bytes'] / 2**20:.1f} MiB" if summary['peak_bytes'] is not None else '')]
+    lines.append(f"{'stage':<22} {'calls':>6} {'wall s':>9} {'share':>6} {'mean s':>8} {'max s':>8} {'cpu s':>9} {'peak MiB':>9}")
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall_s']):
+        lines.append(f"{name:<22} {stage['calls']:>6} {stage['wall_s']:>9.3f} {stage['share']:>6.1%} {stage['mean_wall_s']:>8.3f} "
+                     f"{stage['max_wall_s']:>8.3f} {stage['cpu_s']:>9.3f} {stage['peak_bytes'] / 2**20:>9.1f}")
+    if summary['counts']:
+        lines.append(f"{'count':<22} {'total':>9} {'mean':>9} {'max':>9}")
+        for name, count in sorted(summary['counts'].items()):
+            lines.append(f"{name:<22} {count['total']:>9} {count['mean']:>9.1f} {count['max']:>9}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize a pipeline profile (json lines)')
+    parser.add_argument('profile', help='json lines file written by PipelineProfiler')
+    parser.add_argument('--json', action='store_true', help='print the summary as json')
+    args = parser.parse_args()
+
+    summary = summarize(load_records(args.profile))
+    print(json.dumps(summary, indent=2) if args.json else format_summary(summary))
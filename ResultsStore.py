@@ -0,0 +1,233 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import time
+from datetime import datetime
+
+#append-only sqlite store of phase fraction results, replacing free-text percentages.txt lines for anything
+#that has to be queried later. every row holds the image name and content hash, the mode and settings,
+#the phase fractions, per-stage timings (when profiled), the code version and the time it was processed
+#rows are inserted in batched transactions and the table refuses updates and deletes, so a rerun adds
+#new rows next to the old ones. the lot and magnification are parsed from the image name
+#(e.g. 'HM63-TC380-104HP-02 20x (MIDPLANE).jpg' -> lot 'HM63-TC380-104HP-02', magnification '20x')
+#lot and magnification are indexed with the mode and processing time, and the processing day (utc) has an
+#expression index, so trend queries read their groups in index order instead of sorting the table
+
+schema = '''
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    image TEXT NOT NULL,
+    image_hash TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    lot TEXT,
+    magnification TEXT,
+    parameters TEXT NOT NULL,
+    parameters_key TEXT NOT NULL,
+    boron REAL,
+    carbon REAL,
+    tungsten REAL,
+    polymer REAL,
+    timings TEXT,
+    code_version TEXT,
+    processed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_lot_mode ON results (lot, mode, processed_at);
+CREATE INDEX IF NOT EXISTS results_magnification_mode ON results (magnification, mode, processed_at);
+CREATE INDEX IF NOT EXISTS results_processed_at ON results (processed_at);
+CREATE INDEX IF NOT EXISTS results_day_mode ON results (date(processed_at, 'unixepoch'), mode);
+CREATE INDEX IF NOT EXISTS results_image ON results (image_hash, parameters_key);
+CREATE TRIGGER IF NOT EXISTS results_no_update BEFORE UPDATE ON results
+    BEGIN SELECT RAISE(ABORT, 'results are append-only'); END;
+CREATE TRIGGER IF NOT EXISTS results_no_delete BEFORE DELETE ON results
+    BEGIN SELECT RAISE(ABORT, 'results are append-only'); END;
+'''
+
+#processing day of a row; must match the results_day_mode index expression exactly for it to be used
+#(utc, since an index cannot depend on the local time zone)
+day_expression = "date(processed_at, 'unixepoch')"
+
+columns = ['id', 'image', 'image_hash', 'mode', 'lot', 'magnification', 'parameters', 'parameters_key',
+           'boron', 'carbon', 'tungsten', 'polymer', 'timings', 'code_version', 'processed_at']
+
+#percentages in the order bcp/btp return them, by column
+phase_columns = {'bcp': ('boron', 'carbon', 'polymer'), 'btp': ('boron', 'tungsten', 'polymer')}
+
+#sha256 of a file's bytes, read in chunks
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+#short digest of the mode and settings an image is processed with
+def parameters_key(mode, settings):
+    return hashlib.sha256(json.dumps({'mode': mode, **settings}, sort_keys=True).encode()).hexdigest()[:16]
+
+#magnification token ('10x', '20x', ...) in an image name, or None
+def magnification_from_name(image_file):
+    match = re.search(r'(?<![0-9A-Za-z])(\d+x)(?![A-Za-z])', image_file, re.IGNORECASE)
+    return match.group(1).lower() if match else None
+
+#sample lot: the part of the image name before the magnification, or None when nothing precedes it
+def lot_from_name(image_file):
+    stem = os.path.splitext(image_file)[0]
+    match = re.search(r'(?<![0-9A-Za-z])\d+x(?![A-Za-z])', stem, re.IGNORECASE)
+    lot = (stem[:match.start()] if match else stem).strip(' -_')
+    return lot or None
+
+#git description of the checkout the code runs from ('unknown' outside a git checkout)
+def code_version():
+    try:
+        result = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+    return result.stdout.strip() or 'unknown'
+
+#wall seconds per stage of a Profiling record, or None without one
+def stage_timings(record):
+    if not record:
+        return None
+    return {name: stage['wall_s'] for name, stage in record['stages'].items()}
+
+#unix time of an iso date or datetime string (or a number, passed through)
+def to_timestamp(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return datetime.fromisoformat(value).timestamp()
+
+class ResultsStore:
+    def __init__(self, path='results.sqlite', batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = []
+        self.version = code_version()
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        #wal lets queries read while a batch or the watcher is writing
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(schema)
+
+    #queues one result; rows are written once batch_size are queued, on flush and on close
+    def add(self, image, image_hash, mode, settings, percentages, timings=None, lot=None, magnification=None,
+            processed_at=None):
+        fractions = dict(zip(phase_columns[mode], (float(value) for value in percentages)))
+        self.pending.append((
+            image, image_hash, mode, lot or lot_from_name(image), magnification or magnification_from_name(image),
+            json.dumps(settings, sort_keys=True), parameters_key(mode, settings),
+            fractions.get('boron'), fractions.get('carbon'), fractions.get('tungsten'), fractions.get('polymer'),
+            json.dumps(timings) if timings else None, self.version, processed_at or time.time()))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany(f'INSERT INTO results ({", ".join(columns[1:])}) '
+                                        f'VALUES ({", ".join("?" * (len(columns) - 1))})', self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    #true when this image content has already been stored with these parameters
+    def has_result(self, image_hash, mode, settings):
+        self.flush()
+        row = self.connection.execute('SELECT 1 FROM results WHERE image_hash = ? AND parameters_key = ? LIMIT 1',
+                                      (image_hash, parameters_key(mode, settings))).fetchone()
+        return row is not None
+
+    #where clause and arguments of the common filters; since/until are iso dates or unix times
+    def filters(self, lot=None, magnification=None, mode=None, since=None, until=None):
+        clauses, arguments = [], []
+        for column, value in (('lot', lot), ('magnification', magnification), ('mode', mode)):
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                arguments.append(value)
+        if since is not None:
+            clauses.append('processed_at >= ?')
+            arguments.append(to_timestamp(since))
+        if until is not None:
+            clauses.append('processed_at < ?')
+            arguments.append(to_timestamp(until))
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', arguments
+
+    #stored rows matching the filters, oldest first
+    def query(self, **filters):
+        self.flush()
+        where, arguments = self.filters(**filters)
+        return [dict(row) for row in
+                self.connection.execute(f'SELECT * FROM results{where} ORDER BY processed_at', arguments)]
+
+    #mean phase fractions per lot, magnification or (utc) day, with sample counts and time span
+    def trend(self, by='lot', **filters):
+        group = {'lot': 'lot', 'magnification': 'magnification', 'day': day_expression}[by]
+        self.flush()
+        where, arguments = self.filters(**filters)
+        rows = self.connection.execute(
+            f'SELECT {group} AS "group", mode, COUNT(*) AS samples, AVG(boron) AS boron, AVG(carbon) AS carbon, '
+            f'AVG(tungsten) AS tungsten, AVG(polymer) AS polymer, MIN(processed_at) AS first, '
+            f'MAX(processed_at) AS last FROM results{where} GROUP BY {group}, mode ORDER BY {group}, mode', arguments)
+        return [dict(row) for row in rows]
+
+    #writes the matching rows to a csv file, or to parquet (needs pandas) for a .parquet path
+    def export(self, path, **filters):
+        rows = self.query(**filters)
+        if path.lower().endswith('.parquet'):
+            try:
+                import pandas as pd
+            except ImportError:
+                raise RuntimeError('writing parquet needs pandas; use a .csv path instead')
+            pd.DataFrame(rows, columns=columns).to_parquet(path, index=False)
+            return len(rows)
+
+        with open(path, 'w', newline='') as table:
+            writer = csv.DictWriter(table, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+        return len(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query and export the results store')
+    parser.add_argument('store', nargs='?', default='results.sqlite')
+    parser.add_argument('--lot')
+    parser.add_argument('--magnification')
+    parser.add_argument('--mode', choices=sorted(phase_columns))
+    parser.add_argument('--since', help='iso date, e.g. 2024-05-01')
+    parser.add_argument('--until', help='iso date (exclusive)')
+    parser.add_argument('--trend', choices=['lot', 'magnification', 'day'],
+                        help='print mean fractions per group (days are utc)')
+    parser.add_argument('--export', help='write the matching rows to this .csv or .parquet file')
+    args = parser.parse_args()
+
+    filters = {'lot': args.lot, 'magnification': args.magnification, 'mode': args.mode,
+               'since': args.since, 'until': args.until}
+    with ResultsStore(args.store) as store:
+        if args.export:
+            print(f'{store.export(args.export, **filters)} rows written to {args.export}')
+        elif args.trend:
+            print(f"{args.trend:<40} {'mode':<4} {'n':>5} {'boron':>7} {'carbon':>7} {'tungsten':>8} {'polymer':>7}")
+            for row in store.trend(args.trend, **filters):
+                values = ' '.join(f'{row[phase]:>{width}.2f}' if row[phase] is not None else f"{'-':>{width}}"
+                                  for phase, width in (('boron', 7), ('carbon', 7), ('tungsten', 8), ('polymer', 7)))
+                print(f"{str(row['group']):<40} {row['mode']:<4} {row['samples']:>5} {values}")
+        else:
+            for row in store.query(**filters):
+                fractions = ', '.join(f'{phase.capitalize()}: {row[phase]:.2f}%' for phase in phase_columns[row['mode']])
+                processed = datetime.fromtimestamp(row['processed_at']).isoformat(timespec='seconds')
+                print(f"{processed} {row['image']} - {fractions}")
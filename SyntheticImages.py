@@ -0,0 +1,148 @@
+import argparse
+import csv
+import json
+import os
+
+import cv2
+import numpy as np
+
+from CVFunctions import magnification_bands, phase_percentages, BORON, CARBON, POLYMER, TUNGSTEN
+
+#synthetic bcp and btp cross sections with known ground truth, for benchmarking speed and accuracy
+#fibres are discs with the radius of the requested magnification (magnification_bands), placed by
+#random sequential addition up to the requested area fraction, with a darker core; the matrix is
+#dark carbon with small polymer inclusions (bcp) or polymer (btp); a share of the fibres in btp
+#images is tungsten, as bright as boron but bluer. a bottom strip of 8% holds a scale bar, as in
+#the real micrographs. the truth (labels and fractions) covers the cropped region bcp/btp process
+#everything is drawn from one seed, so a given set of arguments always gives the same image
+
+#bgr colours of the phases
+matrix_colour = (70, 75, 70)
+polymer_colour = (150, 145, 140)
+boron_colour = (215, 225, 235)
+tungsten_colour = (245, 230, 215)
+core_colour = (160, 150, 150)
+
+#random sequential addition of non-overlapping discs covering about density of the area;
+#centres may lie up to one radius outside the image so edge fibres are cut, as in real images
+def place_fibres(rng, height, width, radius, density, gap=0.08, radius_jitter=0.03, max_attempts=50):
+    target = int(round(density * height * width / (np.pi * radius**2)))
+    spacing2 = (2 * radius * (1 + gap))**2
+    centres = np.zeros((0, 2))
+    radii = []
+    for _ in range(target * max_attempts):
+        if len(radii) >= target:
+            break
+        centre = rng.uniform((-radius, -radius), (width + radius, height + radius))
+        if len(centres) and np.min(np.sum((centres - centre)**2, axis=1)) < spacing2:
+            continue
+        centres = np.vstack([centres, centre])
+        radii.append(radius * rng.uniform(1 - radius_jitter, 1 + radius_jitter))
+    return np.column_stack([centres, radii]) if radii else np.zeros((0, 3))
+
+#one synthetic micrograph and its truth
+#returns (bgr image, truth) with truth holding the phase label map of the cropped image, the boron
+#and tungsten circles (x, y, r) and the phase percentages in the order bcp/btp return them
+def synthetic_micrograph(mode='bcp', size=(1420, 2080), magnification='20x', density=0.35, tungsten_share=0.25,
+                         polymer_density=0.15, noise=6.0, gradient=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    height, width = size
+    cropped_height = int(height * 0.92)
+    min_radius, max_radius, _ = magnification_bands[magnification]
+    radius = (min_radius + max_radius) / 2
+
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = matrix_colour if mode == 'bcp' else polymer_colour
+    labels = np.full((height, width), CARBON if mode == 'bcp' else POLYMER, dtype=np.uint8)
+
+    #small polymer inclusions in the carbon matrix (bcp)
+    if mode == 'bcp' and polymer_density > 0:
+        dot_radius = max(2, int(round(radius * 0.06)))
+        count = int(polymer_density * height * width / (np.pi * dot_radius**2))
+        for x, y in zip(rng.integers(0, width, count), rng.integers(0, height, count)):
+            cv2.circle(image, (int(x), int(y)), dot_radius, polymer_colour, thickness=-1)
+            cv2.circle(labels, (int(x), int(y)), dot_radius, POLYMER, thickness=-1)
+
+    fibres = place_fibres(rng, cropped_height, width, radius, density)
+    tungsten = np.zeros(len(fibres), dtype=bool)
+    if mode == 'btp':
+        tungsten[rng.permutation(len(fibres))[:int(round(tungsten_share * len(fibres)))]] = True
+
+    #drawn with 4 bits of sub-pixel precision so the truth keeps the fractional centres
+    shift = 4
+    for (x, y, r), is_tungsten in zip(fibres, tungsten):
+        centre = (int(round(x * 2**shift)), int(round(y * 2**shift)))
+        cv2.circle(image, centre, int(round(r * 2**shift)), tungsten_colour if is_tungsten else boron_colour,
+                   thickness=-1, lineType=cv2.LINE_8, shift=shift)
+        cv2.circle(labels, centre, int(round(r * 2**shift)), TUNGSTEN if is_tungsten else BORON,
+                   thickness=-1, lineType=cv2.LINE_8, shift=shift)
+        cv2.circle(image, centre, int(round(r * 0.12 * 2**shift)), core_colour, thickness=-1, shift=shift)
+
+    #optics: slight blur, left to right illumination gradient and sensor noise
+    pixels = cv2.GaussianBlur(image, (3, 3), 0).astype(np.float32)
+    pixels *= np.linspace(1 - gradient / 2, 1 + gradient / 2, width, dtype=np.float32)[None, :, None]
+    pixels += rng.standard_normal(pixels.shape, dtype=np.float32) * noise
+    image = np.clip(pixels, 0, 255).astype(np.uint8)
+
+    #scale bar strip, removed by the crop in bcp/btp
+    image[cropped_height:] = 0
+    bar_y = cropped_height + (height - cropped_height) // 2
+    cv2.line(image, (width // 20, bar_y), (width // 20 + width // 8, bar_y), (255, 255, 255), max(1, height // 200))
+
+    labels = labels[:cropped_height]
+    phases = (BORON, CARBON, POLYMER) if mode == 'bcp' else (BORON, TUNGSTEN, POLYMER)
+    truth = {
+        'mode': mode,
+        'magnification': magnification,
+        'labels': labels,
+        'boron': fibres[~tungsten],
+        'tungsten': fibres[tungsten],
+        'fractions': phase_percentages(labels, phases),
+    }
+    return image, truth
+
+#file name of a synthetic image; it names the magnification like the real micrographs
+def synthetic_name(mode, size, magnification, seed):
+    return f'synthetic {mode} {magnification} {size[1]}x{size[0]} seed{seed}.png'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic BCP/BTP micrographs with ground truth')
+    parser.add_argument('output', help='folder for the images; truth goes to <output>/truth')
+    parser.add_argument('--mode', choices=['bcp', 'btp'], action='append', help='modes to generate (default: both)')
+    parser.add_argument('--size', default='1420x2080', help="image sizes as heightxwidth, comma separated")
+    parser.add_argument('--magnification', choices=sorted(magnification_bands), action='append')
+    parser.add_argument('--density', type=float, default=0.35, help='fibre area fraction')
+    parser.add_argument('--noise', type=float, default=6.0, help='gaussian noise sigma in gray levels')
+    parser.add_argument('--gradient', type=float, default=0.05, help='relative illumination change across the image')
+    parser.add_argument('--seeds', type=int, default=1, help='images per combination')
+    args = parser.parse_args()
+
+    truth_folder = os.path.join(args.output, 'truth')
+    os.makedirs(truth_folder, exist_ok=True)
+    sizes = [tuple(int(value) for value in size.split('x')) for size in args.size.split(',')]
+
+    fractions = {}
+    for mode in args.mode or ['bcp', 'btp']:
+        for size in sizes:
+            for magnification in args.magnification or sorted(magnification_bands):
+                for seed in range(args.seeds):
+                    image, truth = synthetic_micrograph(mode, size, magnification, args.density, noise=args.noise,
+                                                        gradient=args.gradient, seed=seed)
+                    name = synthetic_name(mode, size, magnification, seed)
+                    stem = os.path.splitext(name)[0]
+                    cv2.imwrite(os.path.join(args.output, name), image)
+                    #label masks and fraction tables in the formats AutoTune.py reads
+                    cv2.imwrite(os.path.join(truth_folder, stem + '.png'), truth['labels'])
+                    with open(os.path.join(truth_folder, stem + '.json'), 'w') as file:
+                        json.dump({'mode': mode, 'magnification': magnification, 'fractions': truth['fractions'],
+                                   'boron': truth['boron'].tolist(), 'tungsten': truth['tungsten'].tolist()}, file)
+                    fractions.setdefault(mode, []).append((name, truth['fractions']))
+
+    for mode, rows in fractions.items():
+        columns = ['boron', 'carbon', 'polymer'] if mode == 'bcp' else ['boron', 'tungsten', 'polymer']
+        with open(os.path.join(truth_folder, f'{mode}_fractions.csv'), 'w', newline='') as table:
+            writer = csv.writer(table)
+            writer.writerow(['image'] + columns)
+            writer.writerows([name] + [f'{value:.4f}' for value in values] for name, values in rows)
+    print(f'{sum(len(rows) for rows in fractions.values())} images written to {args.output}')
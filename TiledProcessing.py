@@ -0,0 +1,200 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import CVFunctions
+from CVFunctions import radius_band, histogram_thresholds, detect_circles, circle_statistics, \
+    classify_btp_circles, bcp_phase_labels, btp_circle_fill, boron_brightness_mask, btp_phase_labels, \
+    phase_names, BORON, CARBON, POLYMER, TUNGSTEN
+from ImageSource import open_image
+
+#tiled execution of bcp/btp for stitched micrographs too large to process as one array
+#the cropped image is split into tile cores that partition it exactly; each core is padded by an
+#overlap margin of at least one fibre diameter so every circle centred in a core lies wholly inside
+#its padded tile. thresholds come from one histogram summed over all cores, circles are owned by
+#the tile whose core holds their centre (with duplicates across seams removed), and per-core phase
+#counts are summed, so the percentages are exact for the merged circle set
+
+#(core, padded) boxes as (y0, y1, x0, x1); cores partition the height x width image
+def tile_grid(height, width, tile_size, overlap):
+    tiles = []
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            y1, x1 = min(height, y0 + tile_size), min(width, x0 + tile_size)
+            padded = (max(0, y0 - overlap), min(height, y1 + overlap), max(0, x0 - overlap), min(width, x1 + overlap))
+            tiles.append(((y0, y1, x0, x1), padded))
+    return tiles
+
+#contiguous bgr copy of a region; works for arrays and any source that supports 2-D slicing
+def read_region(image, box):
+    y0, y1, x0, x1 = box
+    return np.ascontiguousarray(image[y0:y1, x0:x1])
+
+#first pass over a tile: gray histogram of the core, hough candidates on the padded tile and their
+#brightness statistics; returns only the circles whose centre lies in the core, in image coordinates,
+#with their depth (distance from the centre to the nearest padded edge that is not an image edge)
+def detect_tile(image, tile, image_shape, band, boron_sensitivity, pyramid_levels):
+    (y0, y1, x0, x1), (py0, py1, px0, px1) = tile
+    min_radius, max_radius, min_distance = band
+    region = read_region(image, (py0, py1, px0, px1))
+    gray = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+    hist = np.bincount(gray[y0 - py0:y1 - py0, x0 - px0:x1 - px0].ravel(), minlength=256)
+
+    circles = detect_circles(cv2.GaussianBlur(gray, (9, 9), 2), min_radius, max_radius, min_distance,
+                             boron_sensitivity, pyramid_levels)
+    if circles is None:
+        empty = np.zeros(0)
+        return hist, np.zeros((0, 3), dtype=np.int64), empty, empty, empty
+
+    circles = np.uint16(np.around(circles))[0]
+    avg_brightnesses, avg_blue_brightnesses = circle_statistics(region, gray, circles)
+
+    circles = circles.astype(np.int64) + np.array([px0, py0, 0])
+    x, y = circles[:, 0], circles[:, 1]
+    owned = (x >= x0) & (x < x1) & (y >= y0) & (y < y1)
+
+    height, width = image_shape
+    edges = [(x - px0, px0 > 0), (px1 - 1 - x, px1 < width), (y - py0, py0 > 0), (py1 - 1 - y, py1 < height)]
+    depth = np.full(len(circles), np.inf)
+    for distance, inner in edges:
+        if inner:
+            depth = np.minimum(depth, distance)
+
+    return hist, circles[owned], avg_brightnesses[owned], avg_blue_brightnesses[owned], depth[owned]
+
+#greedy suppression of circles closer than min_distance, keeping the one seen with the most
+#context (largest depth); within one tile hough already enforces min_distance, so this only
+#removes duplicates detected on both sides of a seam
+def merge_tile_circles(circles, depth, min_distance):
+    cells = {}
+    keep = []
+    for i in np.argsort(-depth, kind='stable'):
+        x, y = circles[i, 0], circles[i, 1]
+        cx, cy = int(x // min_distance), int(y // min_distance)
+        neighbours = [j for dx in (-1, 0, 1) for dy in (-1, 0, 1) for j in cells.get((cx + dx, cy + dy), [])]
+        if any((circles[j, 0] - x)**2 + (circles[j, 1] - y)**2 < min_distance**2 for j in neighbours):
+            continue
+        cells.setdefault((cx, cy), []).append(i)
+        keep.append(i)
+    return np.sort(np.array(keep, dtype=np.int64))
+
+#circles (image coordinates) whose inflated disk reaches into box, shifted to box coordinates
+def circles_in_box(circles, box, radius_inflation=1):
+    y0, y1, x0, x1 = box
+    reach = np.ceil(circles[:, 2] * max(radius_inflation, 1)).astype(np.int64) + 1
+    inside = ((circles[:, 0] + reach >= x0) & (circles[:, 0] - reach < x1) &
+              (circles[:, 1] + reach >= y0) & (circles[:, 1] - reach < y1))
+    return circles[inside] - np.array([x0, y0, 0])
+
+#blue histogram of the non-black pixels of the core that lie inside any candidate circle
+#summed over all cores this is the histogram find_optimal_blue_threshold takes its peak from
+def tile_blue_histogram(image, tile, circles):
+    core = tile[0]
+    region = read_region(image, core)
+    mask = np.zeros(region.shape[:2], dtype=np.uint8)
+    for (x, y, r) in circles_in_box(circles, core):
+        cv2.circle(mask, (int(x), int(y)), int(r), 255, thickness=-1)
+    cv2.bitwise_and(mask, cv2.inRange(region, (1, 1, 1), (255, 255, 255)), dst=mask)
+    return cv2.calcHist([region], [0], mask, [256], [0, 256]).ravel()
+
+#label map of one core and its phase counts; writes the labels into labels_out when given
+def tile_labels(image, tile, mode, thresholds, boron_circles, tungsten_circles, radius_inflation, labels_out=None):
+    core = tile[0]
+    y0, y1, x0, x1 = core
+    gray = cv2.cvtColor(read_region(image, core), cv2.COLOR_BGR2GRAY)
+    carbonThreshold, boronThreshold = thresholds
+
+    if mode == 'bcp':
+        labels = bcp_phase_labels(gray, carbonThreshold, boronThreshold,
+                                  circles_in_box(boron_circles, core, radius_inflation), radius_inflation)
+    else:
+        fill = btp_circle_fill(gray.shape, circles_in_box(boron_circles, core, radius_inflation),
+                               circles_in_box(tungsten_circles, core, radius_inflation), radius_inflation)
+        labels = btp_phase_labels(gray, fill, boron_brightness_mask(gray, fill, boronThreshold))
+
+    if labels_out is not None:
+        labels_out[y0:y1, x0:x1] = labels
+    return np.bincount(labels.ravel(), minlength=len(phase_names))
+
+#tiled bcp ('bcp') or btp without corrections ('btp') on a large image (array or region source)
+#returns the label map of the cropped image (None unless return_labels) and the percentages in the
+#same order as bcp/btp; thresholds always come from the shared histogram
+def tiled_labels(mode, image_file, image, boron_sensitivity=10, boron_detection_threshold = 20, radius_inflation = 1,
+                 pyramid_levels = 0, tile_size=4096, workers=None, return_labels=False):
+    # remove the bottom x% percent which includes scale bar and other elements
+    height, width = int(image.shape[0] * 0.92), image.shape[1]
+
+    #with radius_source='content' the radius band is estimated on one tile sized window at the centre of
+    #the image; otherwise it comes from the image name and no window is decoded for it
+    sample_gray = None
+    if CVFunctions.radius_source == 'content':
+        cy, cx, half = height // 2, width // 2, tile_size // 2
+        sample = read_region(image, (max(0, cy - half), min(height, cy + half), max(0, cx - half), min(width, cx + half)))
+        sample_gray = cv2.cvtColor(sample, cv2.COLOR_BGR2GRAY)
+    band = radius_band(image_file, sample_gray)
+    min_radius, max_radius, min_distance = band
+
+    #one fibre diameter, plus the blur kernel and the inflated radius of circles centred in a neighbour
+    overlap = int(np.ceil(2 * max_radius * max(radius_inflation, 1))) + 8
+    tiles = tile_grid(height, width, tile_size, overlap)
+    labels_out = np.zeros((height, width), dtype=np.uint8) if return_labels else None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        detected = list(executor.map(
+            lambda tile: detect_tile(image, tile, (height, width), band, boron_sensitivity, pyramid_levels), tiles))
+
+        hist = np.sum([d[0] for d in detected], axis=0)
+        thresholds = histogram_thresholds(hist, 3)
+        boronThreshold = thresholds[1]
+
+        circles = np.concatenate([d[1] for d in detected])
+        avg_brightnesses = np.concatenate([d[2] for d in detected])
+        avg_blue_brightnesses = np.concatenate([d[3] for d in detected])
+        keep = merge_tile_circles(circles, np.concatenate([d[4] for d in detected]), min_distance)
+        circles, avg_brightnesses, avg_blue_brightnesses = circles[keep], avg_brightnesses[keep], avg_blue_brightnesses[keep]
+
+        if mode == 'bcp':
+            boron = avg_brightnesses > boronThreshold - boron_detection_threshold
+            tungsten = np.zeros_like(boron)
+        elif mode == 'btp':
+            blue_hist = np.sum(list(executor.map(lambda tile: tile_blue_histogram(image, tile, circles), tiles)), axis=0)
+            boron, tungsten = classify_btp_circles(avg_brightnesses, avg_blue_brightnesses, boronThreshold,
+                                                   boron_detection_threshold, np.argmax(blue_hist))
+        else:
+            raise ValueError(f"unknown mode: {mode}")
+
+        counts = np.sum(list(executor.map(
+            lambda tile: tile_labels(image, tile, mode, thresholds, circles[boron], circles[tungsten],
+                                     radius_inflation, labels_out), tiles)), axis=0)
+
+    total_pixels = height * width
+    phases = (BORON, CARBON, POLYMER) if mode == 'bcp' else (BORON, TUNGSTEN, POLYMER)
+    percentages = [(counts[phase] / total_pixels) * 100 for phase in phases]
+    return labels_out, percentages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tiled BCP/BTP detection for very large stitched micrographs')
+    parser.add_argument('image')
+    parser.add_argument('--mode', choices=['bcp', 'btp'], default='bcp')
+    parser.add_argument('--tile-size', type=int, default=4096)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--boron-sensitivity', type=int, default=10)
+    parser.add_argument('--boron-detection-threshold', type=int, default=20)
+    parser.add_argument('--radius-inflation', type=float, default=1.0)
+    parser.add_argument('--pyramid-levels', type=int, default=0)
+    parser.add_argument('--labels', help='write the phase label map to this (png) file')
+    args = parser.parse_args()
+
+    #tiff inputs are memory-mapped, so each tile only decodes its own region
+    image = open_image(args.image)
+    labels, percentages = tiled_labels(args.mode, os.path.basename(args.image), image, args.boron_sensitivity,
+                                       args.boron_detection_threshold, args.radius_inflation, args.pyramid_levels,
+                                       args.tile_size, args.workers, return_labels=bool(args.labels))
+    names = ['Boron', 'Carbon', 'Polymer'] if args.mode == 'bcp' else ['Boron', 'Tungsten', 'Polymer']
+    print(', '.join(f'{name}: {value:.2f}%' for name, value in zip(names, percentages)))
+    if args.labels:
+        cv2.imwrite(args.labels, labels)
@@ -0,0 +1,179 @@
+import argparse
+import os
+import secrets
+import stat
+import sys
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+#resident worker for repeated command line runs
+#"python WarmWorker.py serve" imports opencv and the pipeline once, runs one small detection so the first
+#request does not pay for it, and then serves requests one at a time; "python WarmWorker.py run <images>"
+#sends images (or folders) to it and prints a result line per image as it finishes, so each invocation
+#only starts a bare interpreter. the worker keeps an in-memory stage cache, so rerunning an image with new
+#settings skips the unchanged stages. run falls back to processing in-process when no worker is listening
+#only the standard library is imported at module level, the pipeline is imported by whichever side runs it
+
+default_address = 'localhost:6011'
+
+#connections unpickle whatever they receive, so the authkey must be a secret: a random per-user key
+#is written to key_path (readable by its owner only) by the first serve and read by run and stop;
+#PHASE_WORKER_KEY overrides it
+key_path = os.path.join(os.path.expanduser('~'), '.phase_worker_key')
+
+#the worker's authkey; with create, a new key is generated when there is none, otherwise None
+def worker_key(create=False):
+    key = os.environ.get('PHASE_WORKER_KEY')
+    if key:
+        return key.encode()
+    try:
+        descriptor = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600) if create else None
+    except FileExistsError:
+        descriptor = None
+    if descriptor is not None:
+        with os.fdopen(descriptor, 'w') as key_file:
+            key_file.write(secrets.token_hex(32))
+
+    if not os.path.exists(key_path):
+        return None
+    if os.name == 'posix' and os.stat(key_path).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise PermissionError(f'{key_path} must only be accessible by its owner (chmod 600)')
+    with open(key_path) as key_file:
+        return key_file.read().strip().encode()
+
+def parse_address(text):
+    host, port = text.rsplit(':', 1)
+    return host, int(port)
+
+#imports the pipeline, installs the stage cache and runs bcp once on a small synthetic image
+def prewarm(cache_dir=None, low_memory=False):
+    import CVFunctions
+    from PipelineCache import PipelineCache
+    from SyntheticImages import synthetic_micrograph, synthetic_name
+
+    CVFunctions.low_memory = low_memory
+    CVFunctions.stage_cache = PipelineCache(max_entries=16, cache_dir=cache_dir)
+    size = (360, 520)
+    image, _ = synthetic_micrograph('bcp', size, '10x')
+    CVFunctions.bcp_labels(synthetic_name('bcp', size, '10x', 0), image)
+
+#runs one request and yields ('result', image, line) or ('error', image, message) per image
+#images are files or folders (every image in the folder); parameters are read on every request
+def process_request(request):
+    import batch
+    from CVFunctions import load_parameters
+
+    settings = batch.batch_settings(load_parameters(request['parameters']))
+    output = request.get('output') or ''
+    if output:
+        os.makedirs(output, exist_ok=True)
+
+    image_paths = []
+    for path in request['images']:
+        if os.path.isdir(path):
+            image_paths.extend(os.path.join(path, f) for f in batch.list_images(path))
+        else:
+            image_paths.append(path)
+
+    for image_path in image_paths:
+        folder, image_file = os.path.split(image_path)
+        try:
+            percentages = batch.run_image(folder, image_file, output, settings, request['mode'])
+        except Exception as error:
+            yield 'error', image_path, str(error)
+            continue
+        yield 'result', image_path, batch.format_result(image_file, percentages, request['mode'])
+
+def serve(address, cache_dir=None, low_memory=False):
+    start = time.perf_counter()
+    prewarm(cache_dir, low_memory)
+    print(f'warm in {time.perf_counter() - start:.1f} s, listening on {address[0]}:{address[1]}')
+
+    with Listener(address, authkey=worker_key(create=True)) as listener:
+        while True:
+            try:
+                connection = listener.accept()
+            except AuthenticationError:
+                #a client without the key is turned away; the worker keeps serving
+                continue
+            with connection:
+                try:
+                    request = connection.recv()
+                    if request.get('command') == 'shutdown':
+                        connection.send(('done',))
+                        return
+                    for message in process_request(request):
+                        connection.send(message)
+                    connection.send(('done',))
+                except (EOFError, OSError):
+                    #the client went away mid-request; the worker keeps serving
+                    continue
+
+#sends a request to the worker and yields its messages, or runs it here when no worker is listening
+def submit(request, address):
+    key = worker_key()
+    try:
+        if key is None:
+            raise ConnectionRefusedError
+        connection = Client(address, authkey=key)
+    except (ConnectionRefusedError, FileNotFoundError):
+        print('no warm worker listening, processing in this process', file=sys.stderr)
+        yield from process_request(request)
+        return
+
+    with connection:
+        connection.send(request)
+        while True:
+            message = connection.recv()
+            if message[0] == 'done':
+                return
+            yield message
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resident worker that keeps the pipeline loaded between runs')
+    parser.add_argument('--address', default=default_address, help='host:port the worker listens on')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help='start the worker and keep it running')
+    serve_parser.add_argument('--cache-dir', help='on-disk stage cache, in addition to the in-memory one')
+    serve_parser.add_argument('--low-memory', action='store_true')
+
+    run_parser = commands.add_parser('run', help='process images with the worker')
+    run_parser.add_argument('images', nargs='+', help='image files or folders')
+    run_parser.add_argument('--mode', choices=['bcp', 'btp'], default='bcp')
+    run_parser.add_argument('--parameters', default='Parameters.txt')
+    run_parser.add_argument('--output', default='', help='folder for overlay images (default: none)')
+    run_parser.add_argument('--results', help='also write the result lines to this file')
+
+    commands.add_parser('stop', help='stop a running worker')
+    args = parser.parse_args()
+
+    address = parse_address(args.address)
+    if args.command == 'serve':
+        serve(address, args.cache_dir, args.low_memory)
+    elif args.command == 'stop':
+        key = worker_key()
+        if key is None:
+            sys.exit(f'no worker key in {key_path}; no warm worker has been started')
+        with Client(address, authkey=key) as connection:
+            connection.send({'command': 'shutdown'})
+            connection.recv()
+    else:
+        #paths are made absolute because the worker may have been started from another directory
+        request = {'images': [os.path.abspath(path) for path in args.images], 'mode': args.mode,
+                   'parameters': os.path.abspath(args.parameters),
+                   'output': os.path.abspath(args.output) if args.output else ''}
+        start = time.perf_counter()
+        lines = []
+        for kind, image_path, text in submit(request, address):
+            if kind == 'error':
+                print(f'{os.path.basename(image_path)} failed: {text}', file=sys.stderr)
+                continue
+            print(text, end='')
+            lines.append(text)
+        if args.results:
+            with open(args.results, 'w') as results_file:
+                results_file.writelines(lines)
+        print(f'{len(lines)} images in {time.perf_counter() - start:.2f} s', file=sys.stderr)
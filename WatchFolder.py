@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from CVFunctions import load_parameters
+from batch import batch_settings, list_images, init_worker, process_image, format_result
+from ResultsStore import ResultsStore, file_hash, parameters_key
+
+#watch-folder ingest: polls a folder that images are dropped into during the day and processes every new or
+#changed image on a pool of worker processes. a file is dispatched once its size and modification time have
+#not changed for `settle` seconds, so images still being copied in are not read half-written
+#results are appended to the results file as each image finishes (it is never truncated), and every
+#processed image is recorded in a ledger (json lines) by file content hash and parameters; an image whose
+#hash and parameters are already in the ledger is skipped, also across restarts and renames. parameters
+#are reread on every scan, so changing Parameters.txt reprocesses the folder with the new settings
+#with a results store, every result is also added to it as it finishes
+
+#(content hash, parameters key) of every ledger entry
+def load_ledger(ledger_path):
+    done = set()
+    if os.path.exists(ledger_path):
+        with open(ledger_path) as ledger:
+            for line in ledger:
+                if line.strip():
+                    entry = json.loads(line)
+                    done.add((entry['hash'], entry['parameters']))
+    return done
+
+class FolderWatcher:
+    def __init__(self, folder, results_path='percentages.txt', ledger_path=None, parameters_path='Parameters.txt',
+                 mode='bcp', processed_images_folder='', workers=None, interval=2.0, settle=3.0, store_path=None):
+        self.folder = folder
+        self.results_path = results_path
+        self.ledger_path = ledger_path or os.path.join(folder, '.processed.jsonl')
+        self.parameters_path = parameters_path
+        self.mode = mode
+        self.processed_images_folder = processed_images_folder
+        self.workers = workers or os.cpu_count()
+        self.interval = interval
+        self.settle = settle
+        self.store = ResultsStore(store_path, batch_size=1) if store_path else None
+
+        self.done = load_ledger(self.ledger_path)
+        #file name -> ((size, mtime_ns), time first seen with that signature)
+        self.seen = {}
+        #file name -> signature it was last handled (processed, skipped or failed) with
+        self.handled = {}
+        self.tasks = {}
+
+    #images whose signature has been stable for settle seconds and that have not been handled as they are
+    def ready_images(self, now):
+        ready = []
+        for image_file in list_images(self.folder):
+            try:
+                stat = os.stat(os.path.join(self.folder, image_file))
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if image_file in self.tasks or self.handled.get(image_file) == signature or stat.st_size == 0:
+                continue
+            previous = self.seen.get(image_file)
+            if previous is None or previous[0] != signature:
+                self.seen[image_file] = (signature, now)
+            elif now - previous[1] >= self.settle:
+                ready.append((image_file, signature))
+        return ready
+
+    async def process(self, executor, image_file, signature, settings):
+        loop = asyncio.get_running_loop()
+        path = os.path.join(self.folder, image_file)
+        try:
+            digest = await asyncio.to_thread(file_hash, path)
+            key = (digest, parameters_key(self.mode, settings))
+            if key in self.done:
+                print(f'{image_file} already processed with these parameters, skipped')
+                return
+
+            start = time.perf_counter()
+            percentages = await loop.run_in_executor(executor, process_image, self.folder, image_file,
+                                                     self.processed_images_folder, settings, self.mode)
+            with open(self.results_path, 'a') as results_file:
+                results_file.write(format_result(image_file, percentages, self.mode))
+            with open(self.ledger_path, 'a') as ledger:
+                ledger.write(json.dumps({'image': image_file, 'hash': key[0], 'parameters': key[1], 'mode': self.mode,
+                                         'settings': settings, 'percentages': [float(p) for p in percentages],
+                                         'processed': time.time()}) + '\n')
+            if self.store is not None:
+                self.store.add(image_file, key[0], self.mode, settings, percentages)
+            self.done.add(key)
+            print(f'{image_file} complete in {time.perf_counter() - start:.1f} s')
+        except Exception as error:
+            #a failed image is retried once it changes on disk
+            print(f'{image_file} failed: {error}')
+        finally:
+            self.handled[image_file] = signature
+            del self.tasks[image_file]
+
+    #scans until stopped; with once, returns when every image currently in the folder has been handled
+    async def run(self, once=False):
+        if self.processed_images_folder:
+            os.makedirs(self.processed_images_folder, exist_ok=True)
+
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker) as executor:
+            print(f'watching {self.folder} with {self.workers} workers')
+            while True:
+                settings = batch_settings(load_parameters(self.parameters_path))
+                for image_file, signature in self.ready_images(time.monotonic()):
+                    self.tasks[image_file] = asyncio.create_task(self.process(executor, image_file, signature, settings))
+
+                if once and not self.tasks and all(self.handled.get(image_file) is not None
+                                                   for image_file in list_images(self.folder)):
+                    return
+                await asyncio.sleep(self.interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process images as they are dropped into a folder')
+    parser.add_argument('folder', nargs='?', default='Images')
+    parser.add_argument('--mode', choices=['bcp', 'btp'], default='bcp')
+    parser.add_argument('--parameters', default='Parameters.txt')
+    parser.add_argument('--results', default='percentages.txt', help='results file, appended to')
+    parser.add_argument('--ledger', help='processed image ledger (default: <folder>/.processed.jsonl)')
+    parser.add_argument('--output', default='', help='folder for overlay images (default: none)')
+    parser.add_argument('--store', help='also add every result to this sqlite results store')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between folder scans')
+    parser.add_argument('--settle', type=float, default=3.0, help='seconds a file must be unchanged before it is read')
+    parser.add_argument('--once', action='store_true', help='process what is in the folder now, then exit')
+    args = parser.parse_args()
+
+    watcher = FolderWatcher(args.folder, args.results, args.ledger, args.parameters, args.mode, args.output,
+                            args.workers, args.interval, args.settle, args.store)
+    try:
+        asyncio.run(watcher.run(args.once))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,156 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+
+import CVFunctions
+from CVFunctions import load_parameters, bcp, bcp_labels, btp_headless, load_clicks
+from PipelineCache import PipelineCache
+from ImageSource import open_image
+from Profiling import PipelineProfiler, load_records, summarize, format_summary
+from ResultsStore import ResultsStore, file_hash, stage_timings
+
+image_extensions = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+#bcp settings read from a parameters file, with the same defaults as main.py
+def batch_settings(params):
+    return {
+        'boron_sensitivity': int(params.get('boron_sensitivity', 10)),
+        'boron_detection_threshold': int(params.get('boron_detection_threshold', 20)),
+        'radius_inflation': params.get('radius_inflation', 1.0),
+        'pyramid_levels': int(params.get('pyramid_levels', 0)),
+    }
+
+#every image file in the folder, in a stable (sorted) order
+def list_images(images_folder):
+    return [f for f in sorted(os.listdir(images_folder))
+            if os.path.isfile(os.path.join(images_folder, f)) and f.lower().endswith(image_extensions)]
+
+#each worker runs single-threaded opencv so n processes use n cores without oversubscription
+#with a cache_dir, workers share an on-disk stage cache so reruns with new settings skip unchanged stages
+#with a profile_path, every worker appends one json line of per-stage measurements per image
+def init_worker(cache_dir=None, low_memory=False, profile_path=None, track_memory=False):
+    cv2.setNumThreads(1)
+    CVFunctions.low_memory = low_memory
+    if cache_dir:
+        CVFunctions.stage_cache = PipelineCache(max_entries=8, cache_dir=cache_dir)
+    if profile_path:
+        CVFunctions.profiler = PipelineProfiler(profile_path, track_memory)
+
+#runs bcp or btp on one image and writes its overlay; everything the worker needs is passed in,
+#so no gui or module-level state is involved
+def process_image(images_folder, image_file, processed_images_folder, settings, mode='bcp'):
+    if CVFunctions.profiler is not None:
+        with CVFunctions.profiler.image(image_file):
+            return run_image(images_folder, image_file, processed_images_folder, settings, mode)
+    return run_image(images_folder, image_file, processed_images_folder, settings, mode)
+
+def run_image(images_folder, image_file, processed_images_folder, settings, mode='bcp'):
+    image_path = os.path.join(images_folder, image_file)
+    with CVFunctions.profile_stage('load'):
+        image = open_image(image_path)
+    if image is None:
+        raise ValueError(f"could not read image: {image_file}")
+
+    #btp applies the corrections stored next to the image (see save_clicks), without a window
+    if mode == 'btp':
+        overlay_image, percentages = btp_headless(image_file, image, clicks_array=load_clicks(image_path), **settings)
+        if processed_images_folder:
+            with CVFunctions.profile_stage('write'):
+                cv2.imwrite(os.path.join(processed_images_folder, f'processed_{image_file}'), overlay_image)
+        return percentages
+
+    #the overlay is only rendered when it is written out
+    if processed_images_folder:
+        overlay_image, percentages = bcp(image_file, image, **settings)
+        with CVFunctions.profile_stage('write'):
+            cv2.imwrite(os.path.join(processed_images_folder, f'processed_{image_file}'), overlay_image)
+    else:
+        _, percentages = bcp_labels(image_file, image, **settings)
+    return percentages
+
+#one line of the results file, percentages in the order bcp/btp return them
+def format_result(image_file, percentages, mode='bcp'):
+    if mode == 'btp':
+        boron, tungsten, polymer = percentages
+        return f'{image_file} - Boron: {boron:.2f}%, Tungsten: {tungsten:.2f}%, Polymer: {polymer:.2f}%\n'
+    boron, carbon, polymer = percentages
+    return f'{image_file} - Boron: {boron:.2f}%, Carbon: {carbon:.2f}%, Polymer: {polymer:.2f}%\n'
+
+#processes every image in images_folder with a pool of worker processes
+#lines are appended to results_path as each image finishes; once the batch is done the
+#file is rewritten in sorted file name order so the final report is deterministic
+def run_batch(images_folder, results_path='percentages.txt', processed_images_folder='Processed Images',
+              settings=None, workers=None, cache_dir=None, low_memory=False, profile_path=None, track_memory=False,
+              mode='bcp', store_path=None):
+    settings = settings or batch_settings({})
+    image_files = list_images(images_folder)
+    if processed_images_folder:
+        os.makedirs(processed_images_folder, exist_ok=True)
+
+    results = {}
+    errors = {}
+    start = time.perf_counter()
+    if profile_path:
+        open(profile_path, 'w').close()
+
+    with open(results_path, 'w') as percentage_file, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                initargs=(cache_dir, low_memory, profile_path, track_memory)) as executor:
+        futures = {executor.submit(process_image, images_folder, image_file, processed_images_folder, settings, mode): image_file
+                   for image_file in image_files}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            image_file = futures[future]
+            try:
+                results[image_file] = future.result()
+            except Exception as error:
+                errors[image_file] = error
+                print(f'[{done}/{len(image_files)}] {image_file} failed: {error}')
+                continue
+            percentage_file.write(format_result(image_file, results[image_file], mode))
+            percentage_file.flush()
+            print(f'[{done}/{len(image_files)}] {image_file} complete')
+
+    with open(results_path, 'w') as percentage_file:
+        for image_file in image_files:
+            if image_file in results:
+                percentage_file.write(format_result(image_file, results[image_file], mode))
+
+    print(f'{len(results)} images processed, {len(errors)} failed in {time.perf_counter() - start:.1f} s')
+    records = load_records(profile_path) if profile_path else []
+    if records:
+        print(format_summary(summarize(records)))
+
+    #the whole batch goes into the store in one transaction, with the stage timings when profiled
+    if store_path:
+        timings = {record['image']: stage_timings(record) for record in records}
+        with ResultsStore(store_path, batch_size=len(results) + 1) as store:
+            for image_file in image_files:
+                if image_file in results:
+                    store.add(image_file, file_hash(os.path.join(images_folder, image_file)), mode, settings,
+                              results[image_file], timings.get(image_file))
+    return results, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run BCP (or headless BTP) detection on a folder of images in parallel')
+    parser.add_argument('images_folder', nargs='?', default='Images')
+    parser.add_argument('--mode', choices=['bcp', 'btp'], default='bcp',
+                        help='btp applies the corrections stored in <image>.clicks.json sidecars')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--parameters', default='Parameters.txt')
+    parser.add_argument('--results', default='percentages.txt')
+    parser.add_argument('--output', default='Processed Images', help="folder for overlay images ('' to skip)")
+    parser.add_argument('--cache-dir', help='on-disk cache of intermediate stages, reused across runs')
+    parser.add_argument('--profile', help='write per-stage timings (json lines) to this file and print a summary')
+    parser.add_argument('--profile-memory', action='store_true', help='also trace peak memory per stage (slower)')
+    parser.add_argument('--store', help='also append the results to this sqlite results store')
+    args = parser.parse_args()
+
+    params = load_parameters(args.parameters)
+    run_batch(args.images_folder, args.results, args.output,
+              batch_settings(params), args.workers, args.cache_dir, bool(params.get('low_memory', 0)),
+              args.profile, args.profile_memory, args.mode, args.store)
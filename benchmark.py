@@ -0,0 +1,585 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import CVFunctions
+from CVFunctions import find_thresholds_histogram, find_thresholds_kmeans, circle_statistics, detect_circles, \
+    reassign_clicked_islands, btp_state, btp_headless, bcp, radius_band, preview_state, sensitivity_detections, \
+    bcp_preview, estimate_radius, estimate_magnification, filename_magnification, filename_radius_band, find_thresholds, \
+    bcp_labels, btp_labels, crop_scale_bar
+from SyntheticImages import synthetic_micrograph, synthetic_name
+from FibreTable import fibre_table
+from ParameterSweep import sweep_image, phase_columns as sweep_phase_columns
+from ImageSource import open_image, TiffSource
+
+image_folders = ['exampleImages', 'Images', 'ImagesTemp']
+image_extensions = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+#collects every image in the given folders (skips missing folders and non-image files)
+def find_images(folders):
+    image_paths = []
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for f in sorted(os.listdir(folder)):
+            if f.lower().endswith(image_extensions):
+                image_paths.append(os.path.join(folder, f))
+    return image_paths
+
+#loads an image and applies the same scale bar crop as bcp/btp
+def load_cropped(image_path):
+    image = cv2.imread(image_path)
+    height, width = image.shape[:2]
+    return image[:int(height * 0.92), :]
+
+#cropped image converted to grayscale, as thresholded by bcp/btp
+def load_gray(image_path):
+    return cv2.cvtColor(load_cropped(image_path), cv2.COLOR_BGR2GRAY)
+
+#raw (unvalidated) hough candidates with the bcp/btp settings
+def hough_candidates(gray, image_path, boron_sensitivity=10, pyramid_levels=0):
+    min_radius, max_radius, min_distance = radius_band(image_path, gray)
+    blurred = cv2.GaussianBlur(gray, (9, 9), 2)
+    circles = detect_circles(blurred, min_radius, max_radius, min_distance, boron_sensitivity, pyramid_levels)
+    if circles is None:
+        return np.zeros((0, 3), dtype=np.uint16)
+    return np.uint16(np.around(circles))[0]
+
+#original validation: one full-frame mask, bitwise_and and cvtColor per candidate
+def circle_statistics_reference(image, gray, circles):
+    avg_brightness = []
+    avg_blue_brightness = []
+    for x, y, r in circles:
+        mask = np.zeros_like(gray)
+        cv2.circle(mask, (x, y), r, 255, thickness=-1)
+        masked_image = cv2.bitwise_and(image, image, mask=mask)
+        masked_gray = cv2.cvtColor(masked_image, cv2.COLOR_BGR2GRAY)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avg_brightness.append(np.mean(masked_gray[masked_gray > 0]) if np.any(masked_gray) else np.nan)
+            blue = masked_image[:, :, 0]
+            avg_blue_brightness.append(np.mean(blue[blue > 0]) if np.any(blue) else np.nan)
+    return np.array(avg_brightness), np.array(avg_blue_brightness)
+
+#best-of-n wall time of func(*args) and its last result
+def time_call(func, *args, repeats=3):
+    best = float('inf')
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+#failed checks of all stages run so far; the benchmark exits non-zero when any stage recorded one
+failures = []
+
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print(f'FAIL: {message}')
+    return condition
+
+#times the kmeans and histogram threshold engines on each image and reports
+#the speedup and the largest threshold difference in gray levels
+def benchmark_thresholds(image_paths, tolerance=1.0, repeats=3):
+    print(f"{'image':<60} {'kmeans s':>9} {'hist s':>9} {'speedup':>8} {'max diff':>9}")
+    rows = []
+    for image_path in image_paths:
+        gray = load_gray(image_path)
+        kmeans_time, kmeans_thresholds = time_call(find_thresholds_kmeans, gray, repeats=1)
+        hist_time, hist_thresholds = time_call(find_thresholds_histogram, gray, repeats=repeats)
+        difference = max(abs(h - k) for h, k in zip(hist_thresholds, kmeans_thresholds))
+        speedup = kmeans_time / hist_time if hist_time > 0 else float('inf')
+        flag = '' if difference <= tolerance else '  (outside tolerance)'
+        print(f"{os.path.basename(image_path):<60} {kmeans_time:>9.3f} {hist_time:>9.4f} {speedup:>7.0f}x {difference:>9.3f}{flag}")
+        rows.append((image_path, kmeans_time, hist_time, difference))
+    return rows
+
+#times per-candidate mask validation against circle_statistics and checks the
+#brightness values (and therefore the filtering decisions) are identical; fails when they differ
+def benchmark_circle_statistics(image_paths, boron_sensitivity=10, repeats=3):
+    print(f"{'image':<60} {'circles':>7} {'masks s':>9} {'stats s':>9} {'speedup':>8} {'identical':>9}")
+    rows = []
+    for image_path in image_paths:
+        image = load_cropped(image_path)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        circles = hough_candidates(gray, image_path, boron_sensitivity)
+        reference_time, reference = time_call(circle_statistics_reference, image, gray, circles, repeats=1)
+        stats_time, stats = time_call(circle_statistics, image, gray, circles, repeats=repeats)
+        identical = all(np.allclose(a, b, rtol=0, atol=1e-9, equal_nan=True) for a, b in zip(reference, stats))
+        speedup = reference_time / stats_time if stats_time > 0 else float('inf')
+        print(f"{os.path.basename(image_path):<60} {len(circles):>7} {reference_time:>9.3f} {stats_time:>9.4f} {speedup:>7.0f}x {str(identical):>9}")
+        check(identical, f'circle statistics: {os.path.basename(image_path)} differs from the per-candidate masks')
+        rows.append((image_path, len(circles), reference_time, stats_time, identical))
+    return rows
+
+#original btp correction: every pixel of every island is checked against the click set
+def reassign_clicked_islands_reference(mask, clicks_array):
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    green_mask = np.zeros_like(mask, dtype=np.uint8)
+    clicks_set = set(tuple(coord) for coord in clicks_array)
+
+    for label in range(1, num_labels):
+        island_coords = np.argwhere(labels == label)
+        for coord in island_coords:
+            coord_tuple = tuple(coord)[::-1]
+            if coord_tuple in clicks_set:
+                green_mask[labels == label] = 255
+                mask[labels == label] = 0
+    return green_mask
+
+#deterministic test clicks: points on a few islands, on the background and outside the image
+def island_clicks(mask, n_clicks=8, seed=0):
+    rng = np.random.default_rng(seed)
+    ys, xs = np.nonzero(mask)
+    clicks = []
+    if len(xs):
+        picks = rng.choice(len(xs), size=min(n_clicks, len(xs)), replace=False)
+        clicks += [(int(xs[i]), int(ys[i])) for i in picks]
+    height, width = mask.shape[:2]
+    clicks += [(int(rng.integers(width)), int(rng.integers(height))) for _ in range(n_clicks)]
+    clicks += [(-5, 3), (width + 10, height // 2), (width // 2, -40)]
+    return np.array(clicks)
+
+#checks the label lookup reassignment gives the same green_mask and mask as the original
+#per-pixel loop on the btp boron masks of real images; the reference loop is quadratic in the
+#number of islands, so it runs on a crop of the mask; fails when either mask differs
+def benchmark_islands(image_paths, crop=1024, repeats=3):
+    print(f"{'image':<60} {'islands':>7} {'loop s':>9} {'lookup s':>9} {'speedup':>8} {'identical':>9}")
+    rows = []
+    for image_path in image_paths:
+        mask = btp_state(image_path, cv2.imread(image_path))['mask']
+        height, width = mask.shape[:2]
+        y0, x0 = max(0, (height - crop) // 2), max(0, (width - crop) // 2)
+        mask = np.ascontiguousarray(mask[y0:y0 + crop, x0:x0 + crop])
+        clicks = island_clicks(mask)
+
+        reference_mask = mask.copy()
+        reference_time, reference_green = time_call(reassign_clicked_islands_reference, reference_mask, clicks, repeats=1)
+        lookup_mask = mask.copy()
+        lookup_time, lookup_green = time_call(reassign_clicked_islands, lookup_mask, clicks, repeats=1)
+        for _ in range(repeats - 1):
+            lookup_time = min(lookup_time, time_call(reassign_clicked_islands, mask.copy(), clicks, repeats=1)[0])
+
+        identical = np.array_equal(reference_green, lookup_green) and np.array_equal(reference_mask, lookup_mask)
+        islands = cv2.connectedComponents(mask, connectivity=8)[0] - 1
+        speedup = reference_time / lookup_time if lookup_time > 0 else float('inf')
+        print(f"{os.path.basename(image_path):<60} {islands:>7} {reference_time:>9.3f} {lookup_time:>9.4f} {speedup:>7.0f}x {str(identical):>9}")
+        check(identical, f'islands: {os.path.basename(image_path)} reassignment differs from the per-pixel loop')
+        rows.append((image_path, islands, reference_time, lookup_time, identical))
+    return rows
+
+#peak traced allocation (bytes) and wall time while running func(*args)
+def peak_memory(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        func(*args)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak, elapsed
+
+#peak memory of full bcp and btp runs relative to the input image size, with and without
+#CVFunctions.low_memory; the low-memory target is about 3x the input
+def benchmark_memory(image_paths):
+    print(f"{'image':<60} {'mode':>4} {'input MB':>8} {'normal MB':>9} {'x':>5} {'low MB':>8} {'x':>5} {'normal s':>8} {'low s':>7}")
+    rows = []
+    for image_path in image_paths:
+        image = cv2.imread(image_path)
+        input_mb = image.nbytes / 2**20
+        for mode, func in (('bcp', bcp), ('btp', btp_headless)):
+            results = {}
+            for setting in (False, True):
+                CVFunctions.low_memory = setting
+                try:
+                    results[setting] = peak_memory(func, image_path, image)
+                finally:
+                    CVFunctions.low_memory = False
+            (normal_peak, normal_time), (low_peak, low_time) = results[False], results[True]
+            print(f"{os.path.basename(image_path):<60} {mode:>4} {input_mb:>8.1f} {normal_peak / 2**20:>9.1f} {normal_peak / image.nbytes:>4.1f}x "
+                  f"{low_peak / 2**20:>8.1f} {low_peak / image.nbytes:>4.1f}x {normal_time:>8.2f} {low_time:>7.2f}")
+            rows.append((image_path, mode, image.nbytes, normal_peak, low_peak))
+    return rows
+
+#greedy one-to-one matching of circles by centre distance; returns (reference index, other index, distance)
+def match_circles(reference, other, max_distance):
+    reference = np.asarray(reference, dtype=np.float64).reshape(-1, 3)
+    other = np.asarray(other, dtype=np.float64).reshape(-1, 3)
+    if len(reference) == 0 or len(other) == 0:
+        return []
+    distances = np.hypot(reference[:, None, 0] - other[None, :, 0], reference[:, None, 1] - other[None, :, 1])
+    matches = []
+    used_reference, used_other = set(), set()
+    for flat in np.argsort(distances, axis=None):
+        i, j = np.unravel_index(flat, distances.shape)
+        if distances[i, j] > max_distance:
+            break
+        if i in used_reference or j in used_other:
+            continue
+        used_reference.add(i)
+        used_other.add(j)
+        matches.append((i, j, distances[i, j]))
+    return matches
+
+#boron candidates bcp accepts among raw hough candidates (brightness above the boron threshold
+#less boron_detection_threshold)
+def accepted_circles(image, gray, circles, boron_detection_threshold=20):
+    if len(circles) == 0:
+        return circles
+    avg_brightnesses, _ = circle_statistics(image, gray, circles)
+    return circles[avg_brightnesses > find_thresholds(gray, 3)[1] - boron_detection_threshold]
+
+#times full resolution hough against pyramid detection and reports how many full resolution circles
+#are reproduced, of all raw candidates and of those bcp accepts as boron, and how far their centres
+#and radii move. fails when the pyramid recalls fewer than min_recall of the accepted circles of an
+#image whose name gives its magnification (otherwise the radius band itself is only a guess)
+def benchmark_pyramid(image_paths, boron_sensitivity=10, levels=(1, 2), min_recall=0.75, repeats=1):
+    print(f"{'image':<60} {'level':>5} {'full s':>8} {'pyr s':>8} {'speedup':>8} {'raw':>9} {'accepted':>9} "
+          f"{'extra':>5} {'mean off':>8} {'max off':>7} {'max dr':>6}")
+    rows = []
+    for image_path in image_paths:
+        image_file = os.path.basename(image_path)
+        image = load_cropped(image_path)
+        gray = load_gray(image_path)
+        min_radius = radius_band(image_path, gray)[0]
+        full_time, full = time_call(hough_candidates, gray, image_path, boron_sensitivity, 0, repeats=repeats)
+        full_accepted = accepted_circles(image, gray, full)
+        for level in levels:
+            pyramid_time, pyramid = time_call(hough_candidates, gray, image_path, boron_sensitivity, level, repeats=repeats)
+            pyramid_accepted = accepted_circles(image, gray, pyramid)
+            raw_matches = match_circles(full, pyramid, max_distance=min_radius / 4)
+            matches = match_circles(full_accepted, pyramid_accepted, max_distance=min_radius / 4)
+            offsets = [d for _, _, d in matches]
+            radius_changes = [abs(float(full_accepted[i][2]) - float(pyramid_accepted[j][2])) for i, j, _ in matches]
+            recall = len(matches) / len(full_accepted) if len(full_accepted) else 1.0
+            speedup = full_time / pyramid_time if pyramid_time > 0 else float('inf')
+            print(f"{image_file:<60} {level:>5} {full_time:>8.3f} {pyramid_time:>8.3f} {speedup:>7.1f}x "
+                  f"{len(raw_matches):>4}/{len(full):<4} {len(matches):>4}/{len(full_accepted):<4} "
+                  f"{len(pyramid_accepted) - len(matches):>5} {np.mean(offsets) if offsets else 0:>8.2f} "
+                  f"{max(offsets, default=0):>7.2f} {max(radius_changes, default=0):>6.1f}")
+            if filename_magnification(image_file) is not None:
+                check(recall >= min_recall, f'pyramid: level {level} recalls {len(matches)}/{len(full_accepted)} '
+                                            f'accepted circles of {image_file}, below {min_recall:.0%}')
+            rows.append((image_path, level, full_time, pyramid_time, len(full), len(pyramid), len(raw_matches), recall,
+                         offsets))
+    return rows
+
+#live preview: time to build the preview state once, the first draw at each sensitivity (a real
+#hough run), the slowest redraw once it is cached, and the preview against a full resolution bcp run
+#fails when the preview's circles at a sensitivity are not exactly the ones hough finds
+def benchmark_preview(image_paths, sensitivities=(5, 10, 15, 20), repeats=3):
+    print(f"{'image':<60} {'build s':>8} {'sens':>4} {'first s':>8} {'redraw ms':>9} {'circles':>7} {'exact':>5} {'max diff':>8}")
+    rows = []
+    for image_path in image_paths:
+        image_file = os.path.basename(image_path)
+        image = cv2.imread(image_path)
+        gray = load_gray(image_path)
+        build_time, preview = time_call(preview_state, image_file, image, repeats=1)
+        for sensitivity in sensitivities:
+            first_time, (_, percentages) = time_call(bcp_preview, preview, sensitivity, 20, repeats=1)
+            redraw_time = max(time_call(bcp_preview, preview, sensitivity, threshold, repeats=repeats)[0]
+                              for threshold in (10, 20, 40))
+            exact = hough_candidates(gray, image_path, sensitivity)
+            circles = sensitivity_detections(preview, sensitivity)['circles']
+            same = np.array_equal(circles, exact)
+            check(same, f'preview: {image_file} at sensitivity {sensitivity} has {len(circles)} circles, '
+                        f'hough finds {len(exact)}')
+            difference = np.max(np.abs(np.array(percentages) - bcp(image_file, image, sensitivity, 20)[1]))
+            print(f"{image_file:<60} {build_time:>8.3f} {sensitivity:>4} {first_time:>8.3f} {redraw_time * 1000:>9.1f} "
+                  f"{len(circles):>7} {'yes' if same else 'no':>5} {difference:>8.2f}")
+            rows.append((image_path, sensitivity, build_time, first_time, redraw_time, len(exact), same, difference))
+    return rows
+
+#parameter sweep cells against direct runs: every setting of a small grid is swept on each image
+#and compared with bcp/btp_headless (without corrections) at that setting; fails on any difference
+def benchmark_sweep(image_paths, sensitivities=(10, 20), detection_thresholds=(10, 30), modes=('bcp', 'btp')):
+    print(f"{'image':<60} {'mode':>4} {'sweep s':>8} {'direct s':>8} {'cells':>5} {'max diff':>8}")
+    rows = []
+    for image_path in image_paths:
+        image_file = os.path.basename(image_path)
+        image = cv2.imread(image_path)
+        for mode in modes:
+            sweep_time, cells = time_call(lambda: sweep_image(image_path, mode, sensitivities, detection_thresholds),
+                                          repeats=1)
+            run = bcp if mode == 'bcp' else btp_headless
+            start = time.perf_counter()
+            difference = 0.0
+            for cell in cells:
+                direct = run(image_file, image, cell['boron_sensitivity'], cell['boron_detection_threshold'],
+                             cell['radius_inflation'])[1]
+                swept = [cell[column] for column in sweep_phase_columns[mode]]
+                difference = max(difference, float(np.max(np.abs(np.array(swept) - direct))))
+                check(swept == list(direct), f"sweep: {image_file} {mode} at sensitivity {cell['boron_sensitivity']}, "
+                                             f"threshold {cell['boron_detection_threshold']} gives {swept}, "
+                                             f"direct run {list(direct)}")
+            direct_time = time.perf_counter() - start
+            print(f"{image_file:<60} {mode:>4} {sweep_time:>8.2f} {direct_time:>8.2f} {len(cells):>5} {difference:>8.2g}")
+            rows.append((image_path, mode, sweep_time, direct_time, len(cells), difference))
+    return rows
+
+#content based radius estimation: the estimated fibre radius and the magnification band it falls in
+#against the magnification in the file name, the narrowed band radius_band picks in content mode, and
+#hough with it against hough over the whole file name band (time and the share of the accepted
+#circles it reproduces). fails, for an image that names its magnification, when the estimate puts it
+#in another band, the narrowed band leaves the named one, or it recalls fewer than min_recall circles
+def benchmark_radius(image_paths, boron_sensitivity=10, min_recall=0.95, repeats=3):
+    print(f"{'image':<60} {'est ms':>7} {'radius':>7} {'estimated':>9} {'file name':>9} {'content band':>15} "
+          f"{'name s':>7} {'band s':>7} {'speedup':>8} {'accepted':>9}")
+    rows = []
+    source = CVFunctions.radius_source
+    try:
+        for image_path in image_paths:
+            image_file = os.path.basename(image_path)
+            image = load_cropped(image_path)
+            gray = load_gray(image_path)
+            estimate_time, radius = time_call(estimate_radius, gray, repeats=repeats)
+            estimated = estimate_magnification(gray)
+            named = filename_magnification(image_file)
+
+            CVFunctions.radius_source = 'filename'
+            name_time, name_circles = time_call(hough_candidates, gray, image_file, boron_sensitivity, repeats=1)
+            CVFunctions.radius_source = 'content'
+            band = radius_band(image_file, gray)
+            band_time, band_circles = time_call(hough_candidates, gray, image_file, boron_sensitivity, repeats=1)
+
+            name_accepted = accepted_circles(image, gray, name_circles)
+            matches = match_circles(name_accepted, accepted_circles(image, gray, band_circles),
+                                    max_distance=filename_radius_band(image_file)[0] / 4)
+            recall = len(matches) / len(name_accepted) if len(name_accepted) else 1.0
+            speedup = name_time / band_time if band_time > 0 else float('inf')
+            print(f"{image_file:<60} {estimate_time * 1000:>7.1f} {radius if radius is not None else float('nan'):>7.1f} "
+                  f"{str(estimated):>9} {str(named):>9} {str(band):>15} {name_time:>7.3f} {band_time:>7.3f} "
+                  f"{speedup:>7.1f}x {len(matches):>4}/{len(name_accepted):<4}")
+            if named is not None:
+                min_radius, max_radius, min_distance = filename_radius_band(image_file)
+                check(estimated in (None, named), f'radius: {image_file} is {named} but its estimated radius '
+                                                  f'{radius:.1f} falls in the {estimated} band')
+                check(min_radius <= band[0] <= band[1] <= max_radius and band[2] == min_distance,
+                      f'radius: {image_file} content band {band} is outside the {named} band')
+                check(recall >= min_recall, f'radius: the content band of {image_file} recalls '
+                                            f'{len(matches)}/{len(name_accepted)} accepted circles, below {min_recall:.0%}')
+            rows.append((image_path, estimate_time, radius, estimated, named, band, name_time, band_time, recall))
+    finally:
+        CVFunctions.radius_source = source
+    return rows
+
+#precision and recall of detected circles against true ones (centres within a quarter radius)
+#hough only finds centres inside the image, so true circles centred outside it are left out
+def detection_accuracy(truth_circles, detected, min_radius, shape):
+    height, width = shape[:2]
+    x, y = truth_circles[:, 0], truth_circles[:, 1]
+    truth_circles = truth_circles[(x >= 0) & (x < width) & (y >= 0) & (y < height)]
+    matches = match_circles(truth_circles, detected, max_distance=min_radius / 4)
+    precision = len(matches) / len(detected) if len(detected) else 1.0
+    recall = len(matches) / len(truth_circles) if len(truth_circles) else 1.0
+    return precision, recall
+
+#synthetic images with known truth across sizes and magnifications: time of each stage and of the
+#full bcp/btp run (with throughput in megapixels per second), and accuracy of the result: largest
+#phase fraction error in percentage points, pixel accuracy of the label map and precision/recall
+#of the boron (and tungsten) circles; every image comes from a fixed seed, so runs are comparable
+def benchmark_synthetic(sizes=((1420, 2080), (2840, 4160)), magnifications=('10x', '20x'), modes=('bcp', 'btp'),
+                        boron_sensitivity=10, repeats=1, seed=0):
+    print(f"{'mode':<4} {'mag':>4} {'size':>10} {'thresh s':>8} {'hough s':>8} {'valid s':>8} {'full s':>7} {'Mpx/s':>6} "
+          f"{'max err':>7} {'pix acc':>7} {'B prec':>6} {'B rec':>6} {'W prec':>6} {'W rec':>6}")
+    rows = []
+    for mode in modes:
+        for size in sizes:
+            for magnification in magnifications:
+                image, truth = synthetic_micrograph(mode, size, magnification, seed=seed)
+                image_file = synthetic_name(mode, size, magnification, seed)
+                cropped = crop_scale_bar(image)
+                gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
+                min_radius, max_radius, min_distance = radius_band(image_file, gray)
+                blurred = cv2.GaussianBlur(gray, (9, 9), 2)
+
+                threshold_time, (_, boron_threshold) = time_call(find_thresholds, gray, 3, repeats=repeats)
+                hough_time, circles = time_call(detect_circles, blurred, min_radius, max_radius, min_distance,
+                                                boron_sensitivity, repeats=repeats)
+                circles = np.zeros((0, 3), dtype=np.uint16) if circles is None else np.uint16(np.around(circles))[0]
+                validation_time = time_call(circle_statistics, cropped, gray, circles, repeats=repeats)[0]
+
+                if mode == 'bcp':
+                    full_time = time_call(bcp, image_file, image, boron_sensitivity, repeats=repeats)[0]
+                    labels, percentages = bcp_labels(image_file, image, boron_sensitivity)
+                    avg_brightnesses = circle_statistics(cropped, gray, circles)[0]
+                    boron = circles[avg_brightnesses > boron_threshold - 20]
+                    tungsten = np.zeros((0, 3))
+                else:
+                    full_time = time_call(btp_headless, image_file, image, repeats=repeats)[0]
+                    state = btp_state(image_file, image, boron_sensitivity)
+                    labels, percentages = btp_labels(state)
+                    boron, tungsten = state['circles'][state['boron']], state['circles'][state['tungsten']]
+
+                max_error = max(abs(a - b) for a, b in zip(percentages, truth['fractions']))
+                pixel_accuracy = np.count_nonzero(labels == truth['labels']) / labels.size
+                boron_precision, boron_recall = detection_accuracy(truth['boron'], boron, min_radius, gray.shape)
+                tungsten_precision, tungsten_recall = detection_accuracy(truth['tungsten'], tungsten, min_radius, gray.shape)
+                throughput = image.shape[0] * image.shape[1] / 1e6 / full_time
+
+                print(f"{mode:<4} {magnification:>4} {size[1]:>5}x{size[0]:<4} {threshold_time:>8.3f} {hough_time:>8.3f} "
+                      f"{validation_time:>8.3f} {full_time:>7.2f} {throughput:>6.1f} {max_error:>7.2f} {pixel_accuracy:>7.1%} "
+                      f"{boron_precision:>6.2f} {boron_recall:>6.2f} "
+                      + (f"{tungsten_precision:>6.2f} {tungsten_recall:>6.2f}" if mode == 'btp' else f"{'-':>6} {'-':>6}"))
+                rows.append({'mode': mode, 'magnification': magnification, 'size': size,
+                             'thresholds_s': threshold_time, 'hough_s': hough_time, 'validation_s': validation_time,
+                             'full_s': full_time, 'megapixels_per_s': throughput, 'max_fraction_error': max_error,
+                             'pixel_accuracy': pixel_accuracy, 'boron_precision': boron_precision,
+                             'boron_recall': boron_recall, 'tungsten_precision': tungsten_precision,
+                             'tungsten_recall': tungsten_recall})
+    return rows
+
+#uncompressed classic (stripped and, with tifffile, tiled) and bigtiff files must open as a memory-mapped
+#TiffSource and give the same pixels as a full decode; times a full decode against reading one region
+def benchmark_tiff(size=(2840, 4160), region=1024, repeats=3):
+    try:
+        import tifffile
+    except ImportError:
+        tifffile = None
+    image, _ = synthetic_micrograph('btp', size, '20x')
+    writers = {'classic stripped': lambda path: cv2.imwrite(path, image, [cv2.IMWRITE_TIFF_COMPRESSION, 1])}
+    if tifffile is not None:
+        rgb = np.ascontiguousarray(image[:, :, ::-1])
+        writers['classic tiled'] = lambda path: tifffile.imwrite(path, rgb, photometric='rgb', tile=(256, 256))
+        writers['bigtiff stripped'] = lambda path: tifffile.imwrite(path, rgb, photometric='rgb', bigtiff=True,
+                                                                    rowsperstrip=64)
+        writers['bigtiff tiled'] = lambda path: tifffile.imwrite(path, rgb, photometric='rgb', bigtiff=True,
+                                                                 tile=(256, 256))
+    else:
+        print('tifffile is not installed; only the classic stripped file is checked')
+
+    print(f"{'layout':<18} {'source':>10} {'identical':>9} {'full s':>7} {'region s':>8}")
+    rows = []
+    y0, x0 = size[0] // 3, size[1] // 3
+    with tempfile.TemporaryDirectory() as folder:
+        for layout, write in writers.items():
+            path = os.path.join(folder, layout.replace(' ', '_') + '.tif')
+            write(path)
+            source = open_image(path)
+            full_time = time_call(lambda: np.asarray(open_image(path)), repeats=repeats)[0]
+            region_time, tile = time_call(lambda: open_image(path)[y0:y0 + region, x0:x0 + region], repeats=repeats)
+            identical = np.array_equal(tile, image[y0:y0 + region, x0:x0 + region]) and \
+                np.array_equal(np.asarray(source), image)
+            print(f"{layout:<18} {type(source).__name__:>10} {str(identical):>9} {full_time:>7.3f} {region_time:>8.4f}")
+            check(isinstance(source, TiffSource), f'{layout} tiff did not open as a memory-mapped TiffSource')
+            check(identical, f'{layout} tiff pixels differ from the written image')
+            rows.append((layout, type(source).__name__, identical, full_time, region_time))
+    return rows
+
+#fibre table time for the true fibres of synthetic images, with the kd-tree (when scipy is installed) and
+#the numpy neighbour search, and the largest difference between their neighbour metrics
+def benchmark_fibres(sizes=((1420, 2080), (2840, 4160), (5680, 8320)), repeats=3):
+    print(f"{'size':>10} {'fibres':>7} {'kd-tree ms':>10} {'numpy ms':>9} {'max diff':>9}")
+    rows = []
+    for size in sizes:
+        _, truth = synthetic_micrograph('btp', size, '10x')
+        circles = np.vstack([truth['boron'], truth['tungsten']])
+        phases = ['boron'] * len(truth['boron']) + ['tungsten'] * len(truth['tungsten'])
+        zeros = np.zeros(len(circles))
+        shape = (int(size[0] * 0.92), size[1])
+
+        numpy_time, numpy_table = time_call(fibre_table, circles, phases, zeros, zeros, shape, 3.0, 'numpy',
+                                            repeats=repeats)
+        try:
+            kdtree_time, kdtree_table = time_call(fibre_table, circles, phases, zeros, zeros, shape, 3.0, 'kdtree',
+                                                  repeats=repeats)
+            difference = max(np.nanmax(np.abs(kdtree_table[column] - numpy_table[column]), initial=0)
+                             for column in ('nn_distance', 'neighbours', 'local_vf'))
+        except RuntimeError:
+            kdtree_time, difference = float('nan'), float('nan')
+        print(f"{size[1]:>5}x{size[0]:<4} {len(circles):>7} {kdtree_time * 1000:>10.1f} {numpy_time * 1000:>9.1f} "
+              f"{difference:>9.2g}")
+        rows.append((size, len(circles), kdtree_time, numpy_time, difference))
+    return rows
+
+#import time budgets in seconds (cold interpreter, beyond a bare "python -c pass") for the entry points
+#whose start-up is paid on every run; the gui line imports the gui's dependencies without opening a window
+import_budgets = {
+    'CVFunctions': ('import CVFunctions', 1.0),
+    'batch': ('import batch', 1.0),
+    'GUI': ('import flet, CVFunctions, PipelineCache, ImageSource', 2.0),
+    'WarmWorker client': ('import WarmWorker', 0.1),
+}
+
+#per top-level module cumulative import time (seconds) from python -X importtime
+def import_times(statement):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        #nested imports are indented under the module that pulled them in
+        if name.startswith(' ') and not name.startswith('  ') and cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+#cold start of each entry point against its budget, with the heaviest modules it imports; fails when
+#an entry point is over its budget
+def benchmark_imports(budgets=None, repeats=3):
+    budgets = budgets or import_budgets
+    print(f"{'entry point':<20} {'import s':>8} {'budget s':>8} {'':>4}  heaviest imports")
+    baseline = time_call(subprocess.check_call, [sys.executable, '-c', 'pass'], repeats=repeats)[0]
+    rows = []
+    for name, (statement, budget) in budgets.items():
+        try:
+            seconds = time_call(subprocess.check_call, [sys.executable, '-c', statement], repeats=repeats)[0] - baseline
+            heaviest = sorted(import_times(statement).items(), key=lambda item: -item[1])[:3]
+        except subprocess.CalledProcessError:
+            print(f"{name:<20} {'failed':>8} {budget:>8.2f}")
+            continue
+        print(f"{name:<20} {seconds:>8.3f} {budget:>8.2f} {'ok' if seconds <= budget else 'OVER':>4}  "
+              + ', '.join(f'{module} {module_time:.2f}' for module, module_time in heaviest))
+        check(seconds <= budget, f'imports: {name} takes {seconds:.3f} s to import, over its {budget:.2f} s budget')
+        rows.append((name, seconds, budget, heaviest))
+    return rows
+
+stages = {
+    'thresholds': lambda paths, args: benchmark_thresholds(paths, args.tolerance, args.repeats),
+    'circles': lambda paths, args: benchmark_circle_statistics(paths, args.boron_sensitivity, args.repeats),
+    'pyramid': lambda paths, args: benchmark_pyramid(paths, args.boron_sensitivity),
+    'islands': lambda paths, args: benchmark_islands(paths, repeats=args.repeats),
+    'memory': lambda paths, args: benchmark_memory(paths),
+    'preview': lambda paths, args: benchmark_preview(paths, repeats=args.repeats),
+    'radius': lambda paths, args: benchmark_radius(paths),
+    'sweep': lambda paths, args: benchmark_sweep(paths),
+    'synthetic': lambda paths, args: benchmark_synthetic(
+        [tuple(int(value) for value in size.split('x')) for size in args.synthetic_sizes.split(',')],
+        boron_sensitivity=args.boron_sensitivity, repeats=args.repeats),
+    'imports': lambda paths, args: benchmark_imports(repeats=args.repeats),
+    'fibres': lambda paths, args: benchmark_fibres(repeats=args.repeats),
+    'tiff': lambda paths, args: benchmark_tiff(repeats=args.repeats),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark stages of the composite detection pipeline')
+    parser.add_argument('images', nargs='*', help='images to benchmark (defaults to the example folders)')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='allowed threshold difference in gray levels')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--boron-sensitivity', type=int, default=10, help='hough param2 for candidate generation')
+    parser.add_argument('--stage', choices=sorted(stages), action='append', help='stages to run (default: all)')
+    parser.add_argument('--synthetic-sizes', default='1420x2080,2840x4160',
+                        help='sizes (heightxwidth) of the synthetic images of the synthetic stage')
+    args = parser.parse_args()
+
+    image_paths = args.images or find_images(image_folders)
+    for stage in args.stage or stages:
+        print(f"\n== {stage} ==")
+        stages[stage](image_paths, args)
+
+    if failures:
+        print(f'\n{len(failures)} check(s) failed:')
+        for failure in failures:
+            print(f'  {failure}')
+        sys.exit(1)
@@ -0,0 +1,49 @@
+import cv2
+import numpy as np
+
+from CVFunctions import reassign_clicked_islands
+from benchmark import reassign_clicked_islands_reference
+
+#boron mask with islands of several shapes, two of them touching only diagonally (one island at
+#connectivity 8) and one in a corner
+def island_mask():
+    mask = np.zeros((120, 160), dtype=np.uint8)
+    cv2.circle(mask, (30, 30), 12, 255, thickness=-1)
+    cv2.rectangle(mask, (70, 10), (100, 40), 255, thickness=-1)
+    cv2.rectangle(mask, (110, 60), (119, 69), 255, thickness=-1)
+    cv2.rectangle(mask, (120, 70), (129, 79), 255, thickness=-1)
+    cv2.circle(mask, (40, 90), 20, 255, thickness=-1)
+    cv2.rectangle(mask, (150, 110), (159, 119), 255, thickness=-1)
+    return mask
+
+#clicks are (x, y): two on the same island, one on each diagonal half, one on the corner island,
+#one on the background and three outside the image
+clicks = np.array([(30, 30), (35, 28), (112, 62), (128, 78), (159, 119), (60, 60), (-5, 3), (170, 60), (80, -40)])
+
+def test_reassign_matches_reference():
+    mask = island_mask()
+    reference_mask, lookup_mask = mask.copy(), mask.copy()
+    reference_green = reassign_clicked_islands_reference(reference_mask, clicks)
+    lookup_green = reassign_clicked_islands(lookup_mask, clicks)
+
+    assert np.array_equal(lookup_green, reference_green)
+    assert np.array_equal(lookup_mask, reference_mask)
+
+def test_reassign_moves_clicked_islands():
+    mask = island_mask()
+    original = mask.copy()
+    green = reassign_clicked_islands(mask, clicks)
+
+    #the clicked circle, both diagonal halves and the corner island move to the green mask
+    for x, y in [(30, 30), (115, 65), (125, 75), (155, 115)]:
+        assert green[y, x] == 255 and mask[y, x] == 0
+    #islands without a click stay in the boron mask
+    for x, y in [(85, 25), (40, 90)]:
+        assert green[y, x] == 0 and mask[y, x] == 255
+    assert np.array_equal(green | mask, original)
+
+def test_reassign_without_clicks():
+    mask = island_mask()
+    green = reassign_clicked_islands(mask, np.zeros((0, 2), dtype=np.int64))
+    assert not green.any()
+    assert np.array_equal(mask, island_mask())